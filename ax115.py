@@ -0,0 +1,309 @@
+import time
+import asyncio
+import functools
+import logging
+import aiohttp  # pip install aiohttp
+from x115 import Connect115, referer, headers, origin, hosts, ppath
+from stats import stats
+
+log = logging.getLogger(__name__)
+
+
+class AsyncSingleFlight(object):
+    def __init__(self):
+        """
+        asyncio counterpart of x115.SingleFlight
+        """
+        self.calls = {}  # key=asyncio.Future
+
+    async def do(self, key, fn, *args):
+        future = self.calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.calls[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, no warning when nobody waited
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
+
+
+class AsyncConnect115(object):
+    def __init__(self, x115: Connect115, connections: int = 100):
+        """
+        asyncio version of the Connect115 api for event loop servers
+        shares x115.path, listing times and link cache with the synchronous client
+        :param x115: synchronous client, its cookies are reused
+        :param connections: size of the aiohttp connection pool
+        """
+        self.x115 = x115
+        self.connections = connections
+        self.s = None  # created on first use, it needs a running loop
+        self.flight = AsyncSingleFlight()  # coalesces listings by cid and link lookups by pickcode
+
+    def session(self) -> aiohttp.ClientSession:
+        if self.s is None:
+            self.s = aiohttp.ClientSession(headers=headers,
+                                           cookies={c.name: c.value for c in self.x115.s.cookies},
+                                           connector=aiohttp.TCPConnector(limit=self.connections))
+        return self.s
+
+    async def close(self):
+        if self.s is not None:
+            await self.s.close()
+            self.s = None
+
+    async def _get(self, url, **kwargs):
+        return await self._request('GET', url, **kwargs)
+
+    async def _post(self, url, **kwargs):
+        return await self._request('POST', url, **kwargs)
+
+    async def _request(self, method, url, **kwargs):
+        # same policy as Scheduler.request, sharing its rate limits and concurrency limits
+        api = self.x115.api
+        family = api.family(url)
+        endpoint = api.endpoint(url)
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=api.timeout[0], sock_read=api.timeout[1]))
+        for attempt in range(api.retries + 1):
+            delay = api.buckets[family].reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            while not api.limits[family].try_acquire():
+                await asyncio.sleep(0.05)
+            ok, status = False, None
+            start = time.perf_counter()
+            try:
+                async with self.session().request(method, url, **kwargs) as r:
+                    status = r.status
+                    ok = not api.failed(status)
+                    if ok or attempt == api.retries or not (method == 'GET' or status in (429, 503)):
+                        return await r.json(content_type=None), r.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if method != 'GET' or attempt == api.retries:
+                    raise
+            finally:
+                api.limits[family].release(ok)
+                api.record(endpoint, time.perf_counter() - start, ok)
+            await asyncio.sleep(api.delay(attempt))
+
+    async def update_sign(self):
+        url = hosts['115'] + '/?ct=offline&ac=space&_={}'.format(int(time.time() * 1e3))
+        result, _ = await self._get(url, headers={'Referer': referer['115'].format(self.x115.default_dir)})
+        self.x115.sign = result['sign']
+        self.x115.time = result['time']
+
+    async def fs(self) -> dict:
+        now = time.time()
+        if self.x115._fs['last_update'] + self.x115.cache_time < now:
+            url = hosts['webapi'] + '/files/index_info'
+            result, _ = await self._get(url, headers={'Referer': referer['115'].format(self.x115.default_dir)})
+            self.x115._set_fs(result, now)
+        return self.x115._fs
+
+    async def listdir(self, path: str) -> dict:
+        """
+        same as Connect115.listdir, without blocking the event loop
+        """
+        node = await self.load(path)
+        if not node or not node.is_dir:
+            return {}
+        return self.x115.path.children(path)
+
+    async def load(self, path: str):
+        """
+        same as Connect115.load, without blocking the event loop
+        """
+        if not path.startswith('/'):
+            path = '/' + path
+        path = ppath.abspath(path)
+        node = await self.resolve(path)
+        if node and node.is_dir:
+            await self._ensure_listed(path, node)
+        return node
+
+    async def resolve(self, path: str):
+        """
+        same as Connect115.resolve, sharing its negative cache
+        """
+        x115 = self.x115
+        node = x115.path[path]
+        if node:
+            return node
+        path = ppath.abspath('/' + path.strip('/'))
+        if x115._missing(path):
+            return False
+        parent, node = '/', x115.path['/']
+        for name in path.strip('/').split('/'):
+            await self._ensure_listed(parent, node)
+            child = ppath.join(parent, name)
+            node = x115.path[child]
+            if not node or (not node.is_dir and child != path):
+                x115._remember_missing(path, parent)
+                return False
+            parent = child
+        return node
+
+    async def _ensure_listed(self, path, node):
+        fetched = self.x115.listed.get(node.cid)
+        if fetched is None:
+            stats.inc('dir_cache_total', result='miss')
+            await self._listdir(path)
+        elif fetched + self.x115.dir_ttl < time.time():
+            stats.inc('dir_cache_total', result='stale')
+            self._refresh(path, node.cid)
+        else:
+            stats.inc('dir_cache_total', result='hit')
+
+    def _refresh(self, path, cid):
+        with self.x115.path.lock:
+            if cid in self.x115._refreshing:
+                return
+            self.x115._refreshing.add(cid)
+
+        async def refresh():
+            try:
+                await self.sync(path)
+            except Exception as e:
+                log.warning('refresh %s failed: %s', path, e)
+            finally:
+                self.x115._refreshing.discard(cid)
+        asyncio.ensure_future(refresh())
+
+    async def _listdir(self, path):
+        log.debug('listdir %s', path)
+        node = self.x115.path[path]
+        if not node or not node.is_dir:
+            return
+        await self.flight.do(('ls', node.cid), self._store, path, node)
+
+    async def _store(self, path, node, entries=None, complete=True):
+        # the merge takes path.lock and writes the index, off the event loop
+        if entries is None:
+            entries = [i async for i in self.ls(node.cid)]
+        store = functools.partial(self.x115._store, path, node, entries, complete=complete)
+        await asyncio.get_event_loop().run_in_executor(None, store)
+
+    async def sync(self, path) -> bool:
+        """
+        same as Connect115.sync, pages of the delta are requested one after another
+        """
+        log.debug('sync %s', path)
+        node = self.x115.path[path]
+        if not node or not node.is_dir:
+            return False
+        return await self.flight.do(('ls', node.cid), self._sync, path, node)
+
+    async def _sync(self, path, node):
+        x115 = self.x115
+        fresh = None
+        synced = x115.synced.get(node.cid)
+        if synced and synced[1] + x115.full_sync_interval > time.time():
+            plan = x115._delta(x115.path.children(path), synced[0])
+            try:
+                offset = next(plan)
+                while True:
+                    offset = plan.send(await self._ls(node.cid, offset))
+            except StopIteration as e:
+                fresh = e.value
+        if fresh is None:
+            stats.inc('dir_sync_total', result='full')
+            await self._store(path, node)
+            return False
+        stats.inc('dir_sync_total', result='delta')
+        await self._store(path, node, fresh, complete=False)
+        return True
+
+    async def ls(self, folder_id: int = -1):
+        """
+        same as Connect115.ls, remaining pages are fetched concurrently as tasks
+        :return: async generator of dict, yielded as pages arrive
+        """
+        log.debug('ls %s', folder_id)
+        if folder_id == -1:
+            folder_id = self.x115.default_dir
+        result = await self._ls(folder_id, 0)
+        for i in result['data']:
+            yield i
+        count = int(result['count'])
+        if count <= self.x115.page_size:
+            return
+        workers = asyncio.Semaphore(self.x115.ls_workers)
+
+        async def page(offset):
+            async with workers:
+                return await self._ls(folder_id, offset)
+        pages = [asyncio.ensure_future(page(offset)) for offset in range(self.x115.page_size, count, self.x115.page_size)]
+        try:
+            for result in asyncio.as_completed(pages):
+                for i in (await result)['data']:
+                    yield i
+        finally:
+            for p in pages:
+                p.cancel()
+
+    async def _ls(self, folder_id: int, offset: int) -> dict:
+        result, _ = await self._get(self.x115._ls_url(folder_id, offset), headers={'Referer': referer['115'].format(self.x115.default_dir)})
+        if result['errNo'] != 0:
+            raise IOError('ls {} at offset {} failed: {}'.format(folder_id, offset, result.get('error')))
+        return result
+
+    async def dir(self, folder_id: int = 0) -> list:
+        result, _ = await self._get(self.x115._dir_url(folder_id, 0), headers={'Referer': referer['aps']})
+        if result['errNo'] != 0:
+            return
+        data = result['data']
+        count = int(result.get('count', len(data)))
+        pages = await asyncio.gather(*[self._get(self.x115._dir_url(folder_id, offset), headers={'Referer': referer['aps']})
+                                       for offset in range(self.x115.dir_page_size, count, self.x115.dir_page_size)])
+        for result, _ in pages:
+            if result['errNo'] == 0:
+                data.extend(result['data'])
+        return self.x115._add_dirs(data)
+
+    async def ls_task(self, page: int = 1) -> list:
+        """
+        list all tasks starting from page, see Connect115.ls_task
+        pages after the first are fetched concurrently once page_count is known
+        """
+        first = await self._task_page(page)
+        if first is None:
+            return []
+        pages = await asyncio.gather(*[self._task_page(i) for i in range(page + 1, int(first['page_count']) + 1)])
+        data = first['tasks']
+        for result in pages:
+            if result is not None:
+                data.extend(result['tasks'])
+        return data
+
+    async def _task_page(self, page: int) -> dict:
+        url = hosts['115'] + '/web/lixian/?ct=lixian&ac=task_lists'
+        data = {'page': page, 'uid': self.x115.uid, 'sign': self.x115.sign, 'time': self.x115.time}
+        result, _ = await self._post(url, data=data, headers={'Origin': origin['115'], 'Referer': referer['115'].format(self.x115.default_dir)})
+        if result.get('errtype') != 'suc':
+            return None
+        return result
+
+    async def link(self, pickcode: str, stale: str = None) -> tuple:
+        """
+        same as Connect115.link, sharing its cache
+        :return: (url, cookie), (None, None) on failure
+        """
+        cached = self.x115._cached_link(pickcode, stale)
+        if cached:
+            return cached
+        return await self.flight.do(('link', pickcode), self._fetch_link, pickcode)
+
+    async def _fetch_link(self, pickcode: str) -> tuple:
+        result, r_headers = await self._get_link(pickcode)
+        return self.x115._store_link(pickcode, result, r_headers.get('Set-Cookie'))
+
+    async def _get_link(self, pickcode: str) -> tuple:
+        url = hosts['webapi'] + '/files/download'
+        return await self._get(url, params={'pickcode': pickcode, '_': str(int(time.time() * 1e3))}, headers={'Referer': referer['115'].format(self.x115.default_dir)})
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+import mock115
+
+
+def percentiles(samples: list) -> dict:
+    samples = sorted(samples)
+    pick = lambda p: samples[min(int(p * len(samples)), len(samples) - 1)]
+    return {'mean': sum(samples) / len(samples), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': samples[-1]}
+
+
+class Bench(object):
+    def __init__(self, args, mock: mock115.Mock, work: str):
+        """
+        runs each benchmark against the mock, results are collected in self.results
+        :param work: scratch directory for the index and block caches
+        """
+        self.args = args
+        self.mock = mock
+        self.work = work
+        self.results = {}
+
+    def report(self, name: str, value, unit: str = ''):
+        self.results[name] = value
+        if isinstance(value, dict):
+            value = '  '.join(f'{k}={v * 1e3:.2f}ms' for k, v in value.items())
+        elif isinstance(value, float):
+            value = f'{value:.3f}'
+        print(f'{name:<28} {value} {unit}'.rstrip())
+
+    def requests(self) -> int:
+        return sum(v for k, v in self.mock.counts.items() if k != 'cdn_bytes' and not k.startswith('/cdn/'))
+
+    def connect(self, index):
+        from x115 import Connect115
+        x115 = Connect115(index=index)
+        if not self.args.throttle:  # measure the client, not the rate limits meant for the real service
+            for bucket in x115.api.buckets.values():
+                bucket.rate = bucket.burst = bucket.tokens = 1e9
+        return x115
+
+    def startup(self):
+        index = os.path.join(self.work, 'index.db')
+        start = time.perf_counter()
+        x115 = self.connect(index)
+        self.report('startup cold', time.perf_counter() - start, 's')
+        calls = self.requests()
+        start = time.perf_counter()
+        dirs = x115.crawl('/', workers=self.args.workers, qps=1e9 if not self.args.throttle else 10)
+        elapsed = time.perf_counter() - start
+        self.report('crawl', elapsed, 's')
+        self.report('crawl dirs/s', dirs / elapsed)
+        self.report('crawl requests', self.requests() - calls)
+        x115.index.close()
+        start = time.perf_counter()
+        x115 = self.connect(index)
+        self.report('startup from index', time.perf_counter() - start, 's')
+        self.report('entries', len(x115.path.nodes))
+        return x115
+
+    def metadata(self, fs):
+        paths = list(fs.x115.path.nodes)
+        dirs = [p for p in paths if fs.x115.path[p].is_dir]
+        start = time.perf_counter()
+        for p in dirs:
+            for _ in fs('readdir', p, 0):
+                pass
+        self.report('readdir ops/s', len(dirs) / (time.perf_counter() - start))
+        start = time.perf_counter()
+        for p in paths:
+            fs('getattr', p, None)
+        self.report('getattr ops/s', len(paths) / (time.perf_counter() - start))
+        missing = [p + '.missing' for p in paths[:1000]]
+        start = time.perf_counter()
+        for p in missing:
+            try:
+                fs('getattr', p, None)
+            except OSError:
+                pass
+        self.report('getattr ENOENT ops/s', len(missing) / (time.perf_counter() - start))
+
+    def files(self, fs) -> list:
+        return [p for p, node in fs.x115.path.nodes.items() if not node.is_dir]
+
+    def sequential(self, fs, path: str):
+        size = fs.x115.path[path].size
+        chunk = 128 * 1024  # default FUSE max_read
+        node = fs.x115.path[path]
+        for name in ('cold', 'warm'):
+            fh = fs('open', path, os.O_RDONLY)
+            start = time.perf_counter()
+            for offset in range(0, size, chunk):
+                data = fs('read', path, chunk, offset, fh)
+                if self.args.verify and data != self.mock.content.expect(node.pickcode, offset, min(chunk, size - offset)):
+                    raise IOError(f'{path}: bad data at {offset}')
+            elapsed = time.perf_counter() - start
+            fs('release', path, fh)
+            self.report(f'sequential read {name}', size / elapsed / 1024 ** 2, 'MiB/s')
+
+    def random_reads(self, fs, path: str):
+        size = fs.x115.path[path].size
+        fh = fs('open', path, os.O_RDONLY)
+        samples = []
+        rnd = random.Random(0)
+        for _ in range(self.args.random_reads):
+            offset = rnd.randrange(0, max(size - 4096, 1))
+            start = time.perf_counter()
+            fs('read', path, 4096, offset, fh)
+            samples.append(time.perf_counter() - start)
+        fs('release', path, fh)
+        self.report('random 4k read latency', percentiles(samples))
+
+    def delta(self, x115):
+        # change a folder between syncs, every sync must end up with what the mock lists
+        # folders come and go, and a few files: a deleted folder may be offset by an added file
+        tree = self.mock.tree
+        rnd = random.Random(0)
+        cid = int(tree.add(0, 'delta', folder=True)['cid'])
+        x115.sync('/')
+        x115.load('/delta')
+        synced, deltas, calls = 0, 0, self.requests()
+        for n in range(self.args.delta_rounds):
+            for k in range(rnd.choice((0, 1, 2))):
+                tree.add(cid, f'd{n}_{k}', folder=True)
+            if rnd.random() < 0.3:
+                tree.add(cid, f'f{n}.bin')
+            for folder in (True, False):
+                names = [i['n'] for i in tree.listing(cid) if ('s' not in i) == folder]
+                if names and rnd.random() < 0.3:
+                    tree.remove(cid, rnd.choice(names))
+            deltas += x115.sync('/delta')
+            synced += 1
+            expect = {i['n'] for i in tree.listing(cid)}
+            got = set(x115.path.children('/delta'))
+            if got != expect:
+                raise IOError(f'sync round {n}: missing {sorted(expect - got)}, extra {sorted(got - expect)}')
+        if synced:
+            self.report('delta sync share', deltas / synced)
+            self.report('delta sync requests', (self.requests() - calls) / synced)
+
+    def server(self, hosts: dict):
+        # server.py binds the my.115.com:8001 route at import, so it runs on 8001 in its own directory
+        port = 8001
+        cwd = os.path.join(self.work, 'server')
+        os.makedirs(cwd, exist_ok=True)
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cookie.json'), cwd)
+        env = dict(os.environ, X115_HOSTS=json.dumps(hosts), LOG_LEVEL='WARNING')
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+        p = subprocess.Popen([sys.executable, script, '127.0.0.1', str(port)], cwd=cwd, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            deadline = time.time() + 30
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    if p.poll() is not None or time.time() > deadline:
+                        print('server.py did not start:', p.stderr.read().decode(errors='replace').strip().splitlines()[-1:])
+                        return
+                    time.sleep(0.2)
+            import requests
+            url = f'http://127.0.0.1:{port}/dir1?format=json'
+            local = threading.local()
+
+            def get(_):
+                if not hasattr(local, 's'):
+                    local.s = requests.Session()
+                r = local.s.get(url, headers={'Host': f'my.115.com:{port}'})
+                r.raise_for_status()
+            get(0)  # first listing is fetched from the mock
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.clients) as pool:
+                start = time.perf_counter()
+                list(pool.map(get, range(self.args.server_requests)))
+                self.report('server.py listing req/s', self.args.server_requests / (time.perf_counter() - start))
+        finally:
+            p.terminate()
+            p.wait()
+
+    def run(self, hosts: dict):
+        from fs import X115FS
+        x115 = self.startup()
+        fs = X115FS(x115, buffer=self.args.block_size, tmp_dir=os.path.join(self.work, 'tmp'), retain=600,
+                    cache_size=10 * 1024 ** 3, readahead=self.args.readahead, connections=self.args.connections)
+        self.metadata(fs)
+        files = self.files(fs)
+        if files:
+            self.sequential(fs, files[0])
+            self.random_reads(fs, files[-1])
+        if self.args.delta_rounds:
+            self.delta(x115)
+        if self.args.server:
+            self.server(hosts)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='benchmark fs.py and server.py against mock115')
+    mock115.options(parser)
+    parser.set_defaults(depth=2, file_size=32 * 1024 ** 2)
+    parser.add_argument('--throttle', action='store_true', help='keep the scheduler rate limits')
+    parser.add_argument('--workers', type=int, default=8, help='crawl workers')
+    parser.add_argument('--block-size', type=int, default=10 * 1024 ** 2, help='fs.py buffer')
+    parser.add_argument('--readahead', type=int, default=8)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--random-reads', type=int, default=200)
+    parser.add_argument('--verify', action='store_true', help='check the bytes of sequential reads')
+    parser.add_argument('--delta-rounds', type=int, default=200, help='changes of the root folder synced by delta')
+    parser.add_argument('--server', action='store_true', help='also benchmark server.py, needs port 8001')
+    parser.add_argument('--server-requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent server.py clients')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    mock = mock115.from_options(args)
+    hosts = mock.start(port=0)
+    import x115
+    x115.hosts.update(hosts)
+    work = tempfile.mkdtemp(prefix='bench115-')
+    bench = Bench(args, mock, work)
+    try:
+        bench.run(hosts)
+    finally:
+        mock.stop()
+        shutil.rmtree(work, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(bench.results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import threading
+import collections
+from stats import stats
+
+
+class BlockCache(object):
+    def __init__(self, directory: str, block_size: int, budget: int):
+        """
+        fixed size blocks of remote files kept on disk, shared by all handles
+        least recently used blocks are dropped once the total size exceeds budget
+        blocks are keyed by content (sha1), an index file keeps them across restarts
+        :param directory: where block files are stored
+        :param block_size: bytes per block
+        :param budget: max bytes on disk
+        """
+        self.dir = directory
+        self.block_size = block_size
+        self.budget = budget
+        self.used = 0
+        self.lock = threading.Lock()
+        self.blocks = collections.OrderedDict()  # (key, blk)=size, least recently used first
+        self.loading = {}  # (key, blk)=threading.Event, set once the download finished
+        self.index = os.path.join(self.dir, 'index.json')
+        self.save_interval = 60
+        self.saved = 0
+        os.makedirs(self.dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        if index.get('block_size') == self.block_size:
+            for key, blk, size in index['blocks']:
+                try:
+                    if os.path.getsize(self.path(key, blk)) == size:
+                        self.blocks[(key, blk)] = size
+                        self.used += size
+                except OSError:
+                    pass
+        known = {os.path.basename(self.path(key, blk)) for key, blk in self.blocks}
+        for name in os.listdir(self.dir):  # partial downloads, blocks of another block size
+            if name not in known and name != os.path.basename(self.index):
+                os.remove(os.path.join(self.dir, name))
+        self._evict()
+
+    def save(self):
+        """
+        write the index file, called periodically and on unmount
+        """
+        with self.lock:
+            index = {'block_size': self.block_size, 'blocks': [[key, blk, size] for (key, blk), size in self.blocks.items()]}
+            with open(self.index + '.part', 'w') as f:
+                json.dump(index, f)
+            os.replace(self.index + '.part', self.index)
+            self.saved = time.time()
+
+    def path(self, key: str, blk: int) -> str:
+        return os.path.join(self.dir, f'{key}.{blk}')
+
+    def __contains__(self, item) -> bool:
+        return item in self.blocks
+
+    def read(self, key: str, blk: int, offset: int, length: int, fetch) -> bytes:
+        """
+        read from a block, downloading it first if missing
+        :param key: file identity
+        :param blk: block index
+        :param offset: offset inside the block
+        :param length: bytes to read
+        :param fetch: callable writing the whole block into the file object it gets
+        :return: bytes
+        """
+        first = True
+        while True:
+            with self.lock:
+                cached = (key, blk) in self.blocks
+                if cached:
+                    self.blocks.move_to_end((key, blk))
+            if first:
+                stats.inc('block_cache_total', cache=self.dir, result='hit' if cached else 'miss')
+                first = False
+            if cached:
+                try:
+                    with open(self.path(key, blk), 'rb') as f:
+                        return os.pread(f.fileno(), length, offset)
+                except FileNotFoundError:  # evicted meanwhile, or removed behind our back
+                    with self.lock:
+                        if (key, blk) in self.blocks and not os.path.exists(self.path(key, blk)):
+                            self.used -= self.blocks.pop((key, blk))
+            self.load(key, blk, fetch)
+
+    def load(self, key: str, blk: int, fetch):
+        """
+        download a block once, concurrent callers for the same block wait for it
+        """
+        while True:
+            with self.lock:
+                if (key, blk) in self.blocks:
+                    return
+                event = self.loading.get((key, blk))
+                if event is None:
+                    event = self.loading[(key, blk)] = threading.Event()
+                    break
+            event.wait()
+        path = self.path(key, blk)
+        try:
+            with open(path + '.part', 'wb') as f:
+                fetch(f)
+            os.replace(path + '.part', path)
+            self.put(key, blk, os.path.getsize(path))
+        finally:
+            with self.lock:
+                del self.loading[(key, blk)]
+            event.set()
+
+    def put(self, key: str, blk: int, size: int):
+        with self.lock:
+            if (key, blk) in self.blocks:
+                self.used -= self.blocks[(key, blk)]
+            self.blocks[(key, blk)] = size
+            self.used += size
+            self._evict()
+        if self.saved + self.save_interval < time.time():
+            self.save()
+
+    def _evict(self):
+        while self.used > self.budget and len(self.blocks) > 1:
+            (key, blk), size = self.blocks.popitem(last=False)
+            self.used -= size
+            try:
+                os.remove(self.path(key, blk))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,103 @@
+import os
+import queue
+import itertools
+import threading
+import concurrent.futures
+import requests
+from stats import stats
+
+
+class Downloader(object):
+    foreground = 0  # part priorities, lower first
+    background = 1
+
+    def __init__(self, session: requests.Session, connections: int, part_size: int, chunk_size: int = 1024 ** 2,
+                 timeout: tuple = (5, 30)):
+        """
+        split ranges into parts and download them over several pooled connections at once
+        :param session: requests session shared with Connect115, its adapter pool is reused
+        :param connections: max parallel range requests, over all callers; queued foreground parts go first
+        :param part_size: bytes per range request
+        :param chunk_size: bytes written per os.pwrite
+        :param timeout: (connect, read) seconds, a stalled connection fails the block instead of hanging
+        """
+        self.s = session
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.queue = queue.PriorityQueue()  # (priority, seq, future, args) of parts waiting for a connection
+        self.seq = itertools.count()  # fifo within a priority
+        for i in range(connections):
+            threading.Thread(target=self._work, name=f'download-{i}', daemon=True).start()
+
+    def fetch(self, link, headers: dict, offset: int, length: int, f, cancel: threading.Event = None):
+        """
+        download bytes offset to offset + length of a link into f, starting at position 0 of f
+        :param link: callable returning the url, called with the failed url when the link expired (403/410)
+        :param f: file object opened for writing, parts are written with os.pwrite
+        :param cancel: makes this a background fetch, its parts yield to foreground ones and stop with
+                       CancelledError once it is set
+        """
+        fd = f.fileno()
+        priority = self.foreground if cancel is None else self.background
+        failed = threading.Event()  # stops the other parts once one failed
+        stop = (failed,) if cancel is None else (failed, cancel)
+        parts = [self._submit(priority, (link, headers, offset + i, min(self.part_size, length - i), fd, i, stop))
+                 for i in range(0, length, self.part_size)]
+        try:
+            for part in concurrent.futures.as_completed(parts):
+                part.result()
+        except BaseException:
+            failed.set()
+            for part in parts:
+                part.cancel()
+            # running parts write to fd until they stop, the caller closes it once this returns
+            concurrent.futures.wait(parts)
+            raise
+
+    def _submit(self, priority, args):
+        future = concurrent.futures.Future()
+        self.queue.put((priority, next(self.seq), future, args))
+        return future
+
+    def _work(self):
+        while True:
+            _, _, future, args = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._part(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    @staticmethod
+    def _stopped(stop):
+        if any(event.is_set() for event in stop):
+            raise concurrent.futures.CancelledError()
+
+    def _part(self, link, headers, offset, length, fd, pos, stop=()):
+        self._stopped(stop)
+        headers = dict(headers, Range=f'bytes={offset}-{offset + length - 1}')
+        url = link()
+        r = self.s.get(url, headers=headers, stream=True, timeout=self.timeout)
+        if r.status_code in (403, 410):  # signed link expired, get a new one once
+            r.close()
+            url = link(url)
+            r = self.s.get(url, headers=headers, stream=True, timeout=self.timeout)
+        with r:
+            r.raise_for_status()
+            if r.status_code != 206 and offset != 0:  # range ignored, body starts at 0
+                raise IOError(f'range not supported: {r.status_code} {url}')
+            end = pos + length
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    self._stopped(stop)
+                    if len(chunk) > end - pos:
+                        chunk = chunk[:end - pos]
+                    n = os.pwrite(fd, chunk, pos)
+                    pos += n
+                    stats.inc('downloaded_bytes_total', n)
+                    if pos >= end:
+                        break
+        if pos < end:
+            raise IOError(f'short read: {url} at {offset}, {end - pos} bytes missing')
@@ -2,80 +2,138 @@ import os
 import sys
 import time
 import math
+import functools
 import errno
-import shutil
+import heapq
+import uuid
+import logging
+import threading
+import concurrent.futures
 from x115 import Connect115
+from cache import BlockCache
+from download import Downloader
+from stats import stats, setup_logging
 from fuse import FUSE, FuseOSError, Operations  # pip install fusepy
 
+log = logging.getLogger(__name__)
+
 
 class X115FS(Operations):
-    def __init__(self, x115, buffer, tmp_dir, retain):
+    stats_path = '/.stats'  # virtual file, a snapshot of stats.render()
+
+    def __init__(self, x115, buffer, tmp_dir, retain, cache_size, readahead, connections,
+                 writable=False, staging='staging', uploads=4):
         self.x115 = x115
         self.buffer = buffer
-        self.tmp = tmp_dir  # os.path.join(os.getcwd(), tmp_dir)
-        try:
-            shutil.rmtree(self.tmp)
-        except Exception:
-            pass
-        try:
-            os.mkdir(self.tmp)
-        except Exception:
-            pass
+        self.tmp = tmp_dir  # os.path.join(os.getcwd(), tmp_dir), kept across mounts
+        self.cache = BlockCache(self.tmp, self.buffer, cache_size)
+        self.downloader = Downloader(self.x115.s, connections, part_size=max(buffer // connections, 1024 ** 2))
+        self.readahead = readahead  # max blocks downloaded ahead of a sequential reader
+        self.prefetch = concurrent.futures.ThreadPoolExecutor(max_workers=readahead)
         self.retain = retain
+        self.lock = threading.RLock()  # guards the fd tables below
         self.fd = {}
         self._fd = 0
         self.opened_path = {}  # path=fd
-        self.last_read_fh = {}  # fh={time, path}
-        self.last_read_time = {}  # time=fh
+        self.last_read_fh = {}  # fh={time, path}, released handles
+        self.released = []  # heap of (time, fh), entries of reopened handles are skipped by the reaper
+        self.reaper = threading.Condition(self.lock)  # notified when released gets its first entry
         self.uid = os.getuid()
         self.gid = os.getgid()
+        self.stats_text = b''  # snapshot served by stats_path, taken on getattr so st_size matches
+        self.writable = writable
+        self.staging = staging  # written files wait here until uploaded
+        self.staged = {}  # path={name, file, path, refs, version, uploaded, uploading, replaces, deleted, time,
+        #                       future, error, attempts, retry}
+        self.uploads = concurrent.futures.ThreadPoolExecutor(max_workers=uploads)
+        self.upload_backoff = 5  # seconds before retrying a failed upload, doubled per failure
+        self.upload_backoff_max = 10 * 60
+        if writable:
+            os.makedirs(self.staging, exist_ok=True)
+            if os.listdir(self.staging):
+                log.warning('%s holds files of an earlier mount that were never uploaded', self.staging)
         self.log(self.x115.path)
+        threading.Thread(target=self._reap, name='reaper', daemon=True).start()
 
-    def log(self, *args, **kwargs):
-        print(*args, **kwargs)
-        now = time.time() - self.retain
-        for i in sorted(self.last_read_time):
-            if i < now:
-                fh = self.last_read_time[i]
-                f = self.fd[fh]['buffer']
-                f.close()
-                os.remove(f.name)
-                del self.fd[fh]
-                del self.opened_path[self.last_read_fh[fh]['path']]
+    def __call__(self, op, *args):
+        start = time.perf_counter()
+        try:
+            return super().__call__(op, *args)
+        finally:
+            stats.observe('fuse_op_seconds', time.perf_counter() - start, op=op)
+
+    def log(self, *args):
+        if log.isEnabledFor(logging.DEBUG):  # no formatting on the hot path otherwise
+            log.debug(' '.join(map(str, args)))
+
+    def _reap(self):
+        # drop handles released more than retain seconds ago, FUSE operations never wait for this
+        with self.reaper:
+            while True:
+                if not self.released:
+                    self.reaper.wait()
+                    continue
+                t, fh = self.released[0]
+                delay = t + self.retain - time.time()
+                if delay > 0:
+                    self.reaper.wait(delay)
+                    continue
+                heapq.heappop(self.released)
+                r = self.last_read_fh.get(fh)
+                if r is None or r['time'] != t:  # reopened since
+                    continue
+                d = self.fd.pop(fh)
+                for future in d.get('prefetch', {}).values():
+                    future.cancel()
+                if 'cancel' in d:
+                    d['cancel'].set()
+                if self.opened_path.get(r['path']) == fh:  # not a newer handle of the path, stats_path ones are not shared
+                    del self.opened_path[r['path']]
                 del self.last_read_fh[fh]
-                del self.last_read_time[i]
-            else:
-                break
 
     # Filesystem methods
     # ==================
 
+    def destroy(self, path):
+        self.log('destroy', path)
+        self.cache.save()
+
     def access(self, path, mode):
         self.log('access', path, mode)
-        if mode & os.W_OK:
+        if mode & os.W_OK and not self.writable:
             raise FuseOSError(errno.EACCES)
-        elif not self.x115.path[path]:
+        elif path != self.stats_path and path not in self.staged and not self.x115.resolve(path):
             raise FuseOSError(errno.ENOENT)
 
     def getattr(self, path, fh=None):
         self.log('getattr', path, fh)
-        f = self.x115.path[path]
+        if path == self.stats_path:
+            self.stats_text = stats.render().encode()
+            now = time.time()
+            return {'st_gid': self.gid, 'st_uid': self.uid, 'st_nlink': 1, 'st_mode': 0o0100444,
+                    'st_ctime': now, 'st_atime': now, 'st_mtime': now, 'st_size': len(self.stats_text)}
+        staged = self.staged.get(path)
+        if staged:
+            return {'st_gid': self.gid, 'st_uid': self.uid, 'st_nlink': 1, 'st_mode': 0o0100644,
+                    'st_ctime': staged['time'], 'st_atime': staged['time'], 'st_mtime': staged['time'],
+                    'st_size': os.fstat(staged['file'].fileno()).st_size}
+        f = self.x115.resolve(path)  # lists uncached ancestors, misses are remembered
         # self.log(f)
         if f:
-            if 'cid'in f:  # is dir
-                mode = 0o0040555
-                size = len(f)
+            if f.is_dir:
+                mode = 0o0040755 if self.writable else 0o0040555
+                size = len(f.children)
             else:  # is file
-                mode = 0o0100444
-                size = f['size']
+                mode = 0o0100644 if self.writable else 0o0100444
+                size = f.size
             result = {
                 'st_gid': self.gid,
                 'st_uid': self.uid,
                 'st_nlink': 1,
                 'st_mode': mode,
-                'st_ctime': f['time'],  # create time
-                'st_atime': f['time'],  # access time
-                'st_mtime': f['time'],  # modify time
+                'st_ctime': f.time,  # create time
+                'st_atime': f.time,  # access time
+                'st_mtime': f.time,  # modify time
                 'st_size': size
             }
             return result
@@ -85,11 +143,15 @@ class X115FS(Operations):
     def readdir(self, path, fh):
         self.log('readdir', path, fh)
         dirents = ['.', '..']
-        node = self.x115.path[path]
-        if node and 'cid' in node:
+        node = self.x115.resolve(path)
+        if node and node.is_dir:
             dirents.extend(self.x115.listdir(path))
-        for r in dirents:
-            yield r
+            with self.lock:
+                staged = [os.path.basename(i) for i in self.staged if os.path.dirname(i) == path]
+            dirents.extend(set(staged) - set(dirents))
+        if path == '/':
+            dirents.append(self.stats_path[1:])
+        return dirents  # a list, not a generator, so __call__ times the listing
 
     def statfs(self, path):
         self.log('statfs', path)
@@ -109,24 +171,86 @@ class X115FS(Operations):
 
     def rename(self, old, new):
         self.log('rename', old, new)
-        raise FuseOSError(errno.EROFS)
+        self._writable()
+        self._parent(old)
+        self._parent(new)
+        node = self.x115.path[old]
+        with self.lock:
+            staged = self.staged.get(old)
+        if not staged and not node:
+            raise FuseOSError(errno.ENOENT)
+        if old == new:
+            return
+        target = self.x115.path[new]
+        if target and target.is_dir:
+            raise FuseOSError(errno.EEXIST)
+        if target or new in self.staged:  # replaced, as rename(2) does
+            self.unlink(new)
+        if node:
+            self._move(node, old, new)
+        with self.lock:
+            # files staged under a renamed directory follow it, an upload in progress moves its file once done
+            moved = [old] if staged else []
+            if node and node.is_dir:
+                moved.extend(p for p in self.staged if p.startswith(old + '/'))
+            for p in moved:
+                staged = self.staged.pop(p)
+                staged['path'] = new + p[len(old):]
+                self.staged[staged['path']] = staged
+                self.opened_path.pop(staged['path'], None)
+                self.opened_path.pop(p, None)
+            self.opened_path.pop(old, None)
+
+    def _move(self, node, old, new, source=None):
+        # rename or move a remote file or directory
+        # :param source: cid of the directory node is in, for an old path that was renamed meanwhile
+        i = node.cid if node.is_dir else node.fid
+        src, name = os.path.split(old)
+        dest, new_name = os.path.split(new)
+        if source is None:
+            source = self.x115.path[src].cid
+        target = self.x115.path[dest]
+        if not target:
+            raise FuseOSError(errno.ENOENT)
+        ok = True
+        if target.cid != source:
+            ok = self.x115.mv_batch([i], target.cid)
+        if ok and name != new_name:
+            ok = self.x115.ren_batch({i: new_name})
+        if not ok:
+            raise FuseOSError(errno.EIO)
 
     def rmdir(self, path):
         self.log('rmdir', path)
-        raise FuseOSError(errno.EROFS)
+        self._writable()
+        _, parent, _ = self._parent(path)
+        node = self.x115.path[path]
+        if not node:
+            raise FuseOSError(errno.ENOENT)
+        if not node.is_dir:
+            raise FuseOSError(errno.ENOTDIR)
+        if self.x115.listdir(path) or any(os.path.dirname(i) == path for i in self.staged):
+            raise FuseOSError(errno.ENOTEMPTY)
+        if not self.x115.rm_batch(parent.cid, [node.cid]):
+            raise FuseOSError(errno.EIO)
 
     def mkdir(self, path, mode):
-        self.log('mrdir', path, mode)
-        raise FuseOSError(errno.EROFS)
+        self.log('mkdir', path, mode)
+        self._writable()
+        _, parent, name = self._parent(path)
+        if self.x115.path[path] or path in self.staged:
+            raise FuseOSError(errno.EEXIST)
+        if name not in self.x115.mkdir_batch(parent.cid, [name]):
+            raise FuseOSError(errno.EIO)
 
     def chmod(self, path, mode):
         self.log('chmod', path, mode)
-        raise FuseOSError(errno.EROFS)
+        self._writable()  # 115 has no permissions, accepted so cp -p and friends work
         # raise FuseOSError(errno.EPERM)
 
     def chown(self, path, uid, gid):
         self.log('chown', path, uid, gid)
-        raise FuseOSError(errno.EROFS)
+        self._writable()
         # raise FuseOSError(errno.EPERM)
 
     def symlink(self, name, target):
@@ -139,7 +263,19 @@ class X115FS(Operations):
 
     def unlink(self, path):
         self.log('unlink', path)
-        raise FuseOSError(errno.EROFS)
+        self._writable()
+        _, parent, _ = self._parent(path)
+        node = self.x115.path[path]
+        with self.lock:
+            staged = self._drop(path)
+            self.opened_path.pop(path, None)
+        if node and node.is_dir:
+            raise FuseOSError(errno.EISDIR)
+        if node:
+            if not self.x115.rm_batch(parent.cid, [node.fid]):
+                raise FuseOSError(errno.EIO)
+        elif not staged:
+            raise FuseOSError(errno.ENOENT)
 
     def readlink(self, path):
         self.log('readlink', path)
@@ -151,110 +287,339 @@ class X115FS(Operations):
 
     def utimens(self, path, times=None):
         self.log('utimens', path, times)
-        raise FuseOSError(errno.EROFS)
+        self._writable()  # 115 keeps its own times, accepted so touch works
 
     # File methods
     # ============
 
     def open(self, path, flags):
         self.log('open', path, flags)
-        if flags & os.O_WRONLY:  # TODO: proper permission
-            raise FuseOSError(errno.EROFS)
-        f = self.x115.path[path]
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            self._writable()
+            node = self.x115.path[path]
+            with self.lock:
+                staged = self.staged.get(path)
+                if not staged:
+                    if not node:
+                        raise FuseOSError(errno.ENOENT)
+                    if node.size and not flags & os.O_TRUNC:  # would need the whole file downloaded first
+                        raise FuseOSError(errno.EOPNOTSUPP)
+                    staged = self._stage(path, node.fid)
+                if flags & os.O_TRUNC:
+                    os.ftruncate(staged['file'].fileno(), 0)
+                    staged['version'] += 1
+                return self._open_staged(path, staged)
+        with self.lock:
+            staged = self.staged.get(path)
+            if staged:  # not uploaded yet, read it back from staging
+                return self._open_staged(path, staged)
+        if path == self.stats_path:
+            with self.lock:
+                self._fd += 1
+                self.fd[self._fd] = {'path': path, 'refs': 1, 'data': self.stats_text or stats.render().encode()}
+                return self._fd
+        f = self.x115.resolve(path)
         if not f:
             raise FuseOSError(errno.ENOENT)
-        if path in self.opened_path:
-            fh = self.opened_path[path]
-            if fh in self.last_read_fh:
-                t = self.last_read_fh[fh]
-                del self.last_read_time[t['time']]
-                del self.last_read_fh[fh]
-            # self.fd[fh]['buffer'] = open(os.path.join(self.tmp, str(fh)), 'w+b')
-            return fh
-        self._fd += 1
-        url = self.x115.get_url(path).replace('http://', 'https://')
-        self.fd[self._fd] = {
-            'path': path,
-            'size': f['size'],
-            'url': url,
-            'buffer': open(os.path.join(self.tmp, str(self._fd)), 'w+b'),
-            'range': [],
-            'headers': {'Accept-Encoding': '*'}
-        }
-        self.opened_path[path] = self._fd
-        return self._fd
+        with self.lock:
+            if path in self.opened_path:
+                fh = self.opened_path[path]
+                self.fd[fh]['refs'] += 1
+                self.last_read_fh.pop(fh, None)
+                return fh
+            self._fd += 1
+            self.fd[self._fd] = {
+                'path': path,
+                'refs': 1,  # opens sharing this handle, it is retained once all are released
+                'size': f.size,
+                'pickcode': f.pickcode,
+                'key': f.sha.hex() or f.pickcode,  # blocks in self.cache, shared by files of the same content
+                'headers': {'Accept-Encoding': '*'},
+                'lock': threading.Lock(),  # guards the read-ahead state below
+                'next': 0,  # where a sequential read would continue
+                'window': 0,  # blocks to keep downloading ahead
+                'prefetch': {},  # block=Future
+                'cancel': threading.Event()  # set on seek, stops the download parts of running prefetches
+            }
+            self.opened_path[path] = self._fd
+            return self._fd
 
     def read(self, path, length, offset, fh):
         self.log('read', path, length, offset, fh)
-        blk1, o1 = divmod(offset, self.buffer)
-        blk2, o2 = divmod(offset+length, self.buffer)
-        for blk in range(blk1, blk2 + 1):  # one extra buffer
-            if blk not in self.fd[fh]['range']:
-                self._read(blk * self.buffer, fh)
-                self.fd[fh]['range'].append(blk)
-        f = self.fd[fh]['buffer']
-        f.seek(offset)
-        return f.read(length)
-
-    def _read(self, offset, fh):
+        d = self.fd[fh]
+        if 'data' in d:  # stats_path
+            return d['data'][offset:offset + length]
+        if 'staged' in d:
+            return os.pread(d['staged']['file'].fileno(), length, offset)
+        end = min(offset + length, d['size'])
+        self._readahead(fh, offset, end)
+        chunks = []
+        while offset < end:
+            blk, o = divmod(offset, self.buffer)
+            n = min(end - offset, self.buffer - o)
+            chunks.append(self.cache.read(d['key'], blk, o, n, lambda f, blk=blk: self._read(blk * self.buffer, fh, f)))
+            offset += n
+        data = b''.join(chunks)
+        stats.inc('served_bytes_total', len(data))
+        return data
+
+    def _readahead(self, fh, offset, end):
+        # grow the window while reads are sequential, drop pending downloads on seek
+        d = self.fd[fh]
+        with d['lock']:
+            if abs(offset - d['next']) < self.buffer:  # tolerate reordering by parallel FUSE threads
+                d['window'] = min(max(d['window'] * 2, 1), self.readahead)
+            else:
+                d['window'] = 0
+                for future in d['prefetch'].values():
+                    future.cancel()
+                d['cancel'].set()
+                d['cancel'] = threading.Event()
+            d['prefetch'] = {k: v for k, v in d['prefetch'].items() if not v.done()}
+            d['next'] = end
+            last = (d['size'] - 1) // self.buffer
+            start = (end - 1) // self.buffer + 1 if end else 0
+            for blk in range(start, min(start + d['window'], last + 1)):
+                if blk not in d['prefetch'] and (d['key'], blk) not in self.cache:
+                    fetch = functools.partial(self._read, blk * self.buffer, fh, cancel=d['cancel'])
+                    d['prefetch'][blk] = self.prefetch.submit(self.cache.load, d['key'], blk, fetch)
+                    stats.add('prefetch_inflight', 1)
+                    d['prefetch'][blk].add_done_callback(lambda _: stats.add('prefetch_inflight', -1))
+
+    def _read(self, offset, fh, f, cancel=None):
+        # cancel: set for prefetches, their parts wait behind the ones of reads
         self.log('_read', offset, fh)
-        if offset > self.fd[fh]['size']:
+        d = self.fd[fh]
+        if offset >= d['size']:
             return
-        if offset == 0 and self.buffer >= self.fd[fh]['size']:
-            if 'Range' in self.fd[fh]['headers']:
-                del self.fd[fh]['headers']['Range']
-        else:
-            end = offset + self.buffer - 1
-            if end >= self.fd[fh]['size']:
-                end = ''
-            self.fd[fh]['headers'].update({'Range': f'bytes={offset}-{end}'})
-        r = self.x115.s.get(self.fd[fh]['url'], headers=self.fd[fh]['headers'], stream=True)
-        self.log(r, self.fd[fh]['headers'], r.headers)
-        f = self.fd[fh]['buffer']
-        f.seek(offset)
-        for chunk in r.iter_content(chunk_size=4096):
-            if chunk:
-                f.write(chunk)
+        link = functools.partial(self.x115.get_link, d['pickcode'])  # cached, refreshed before expiry or on 403
+        self.downloader.fetch(link, d['headers'], offset, min(self.buffer, d['size'] - offset), f, cancel)
 
     def release(self, path, fh):
         self.log('release', path, fh)
         now = time.time()
-        if now in self.last_read_time:
-            now = sorted(self.last_read_time)[-1] + 1
-        self.last_read_time[now] = fh
-        self.last_read_fh[fh] = {'time': now, 'path': path}
-        # f = self.fd[fh]['buffer']
-        # f.close()
-        # os.remove(f.name)
-        # del self.fd[fh]
+        with self.lock:
+            d = self.fd.get(fh)
+            if d and 'staged' in d:  # written handles are not kept, their file is uploaded once the last one closes
+                del self.fd[fh]
+                staged = d['staged']
+                staged['refs'] -= 1
+                if not staged['refs'] and not staged['uploading'] and staged['deleted']:  # unlinked while open
+                    self._discard(staged)
+                elif not staged['refs'] and not staged['uploading']:
+                    if staged['version'] != staged['uploaded']:
+                        self._schedule(staged)
+                    else:  # uploaded by fsync already
+                        self._forget(staged)
+                return
+            if not d:
+                return
+            d['refs'] -= 1
+            if d['refs'] > 0:  # still read through another open
+                return
+            self.last_read_fh[fh] = {'time': now, 'path': path}
+            heapq.heappush(self.released, (now, fh))
+            if len(self.released) == 1:  # retain is fixed, later entries never expire first, only an idle reaper needs waking
+                self.reaper.notify()
 
     def create(self, path, mode, fi=None):
         self.log('create', path, mode, fi)
-        raise FuseOSError(errno.EROFS)
+        self._writable()
+        self._parent(path)
+        node = self.x115.path[path]
+        if node and node.is_dir:
+            raise FuseOSError(errno.EISDIR)
+        with self.lock:
+            staged = self.staged.get(path) or self._stage(path, node.fid if node else None)
+            os.ftruncate(staged['file'].fileno(), 0)
+            staged['version'] += 1
+            return self._open_staged(path, staged)
 
     def write(self, path, buf, offset, fh):
-        self.log('write', path, buf, offset, fh)
-        raise FuseOSError(errno.EROFS)
+        self.log('write', path, len(buf), offset, fh)
+        staged = self.fd[fh].get('staged')
+        if not staged:
+            raise FuseOSError(errno.EBADF)
+        n = os.pwrite(staged['file'].fileno(), buf, offset)
+        with self.lock:
+            staged['version'] += 1
+            staged['time'] = time.time()
+        return n
 
     def truncate(self, path, length, fh=None):
         self.log('truncate', path, length, fh)
-        raise FuseOSError(errno.EROFS)
+        self._writable()
+        node = self.x115.path[path]
+        with self.lock:
+            staged = self.staged.get(path)
+            if not staged:
+                if not node:
+                    raise FuseOSError(errno.ENOENT)
+                if node.is_dir:
+                    raise FuseOSError(errno.EISDIR)
+                if length:  # would need the file downloaded first
+                    raise FuseOSError(errno.EOPNOTSUPP)
+                staged = self._stage(path, node.fid)
+                if not staged['refs']:  # truncate(2) without an open handle, upload the empty file now
+                    self._schedule(staged)
+            os.ftruncate(staged['file'].fileno(), length)
+            staged['version'] += 1
+
+    # Write-back staging
+    # ==================
+
+    def _writable(self):
+        if not self.writable:
+            raise FuseOSError(errno.EROFS)
+
+    def _parent(self, path):
+        # parent path, parent node and name of path, ENOENT unless the parent is a directory
+        parent, name = os.path.split(path)
+        node = self.x115.path[parent]
+        if not node or not node.is_dir:
+            raise FuseOSError(errno.ENOENT)
+        return parent, node, name
+
+    def _stage(self, path, replaces):
+        # empty staging file for path, caller holds self.lock
+        name = os.path.join(self.staging, uuid.uuid4().hex)
+        staged = {'name': name, 'file': open(name, 'w+b'), 'path': path, 'refs': 0, 'version': 0, 'uploaded': 0,
+                  'uploading': False, 'replaces': replaces, 'deleted': False, 'time': time.time(),
+                  'future': None, 'error': None, 'attempts': 0, 'retry': None}
+        self.staged[path] = staged
+        self.opened_path.pop(path, None)  # read handles of the previous content
+        return staged
+
+    def _open_staged(self, path, staged):
+        # caller holds self.lock
+        staged['refs'] += 1
+        self._fd += 1
+        self.fd[self._fd] = {'path': path, 'staged': staged}
+        return self._fd
+
+    def _drop(self, path):
+        # forget the staging file of path, caller holds self.lock
+        staged = self.staged.pop(path, None)
+        if staged:
+            staged['deleted'] = True  # an upload in progress removes what it created
+            if staged['retry']:
+                staged['retry'].cancel()
+            if not staged['uploading'] and not staged['refs']:  # open handles keep using it, as after unlink(2)
+                self._discard(staged)
+        return staged
+
+    def _forget(self, staged):
+        # drop an uploaded staging file, reads go to 115 from now on, caller holds self.lock
+        if self.staged.get(staged['path']) is staged:
+            del self.staged[staged['path']]
+            self._discard(staged)
+            self.opened_path.pop(staged['path'], None)
+
+    @staticmethod
+    def _discard(staged):
+        staged['file'].close()
+        try:
+            os.remove(staged['name'])
+        except FileNotFoundError:
+            pass
+
+    def _schedule(self, staged):
+        # start uploading a staging file in self.uploads, caller holds self.lock
+        if staged['retry']:
+            staged['retry'].cancel()
+            staged['retry'] = None
+        staged['uploading'] = True
+        staged['future'] = self.uploads.submit(self._upload, staged)
+        return staged['future']
+
+    def _retry(self, staged):
+        # timer of a failed upload, skipped when written, fsynced or deleted meanwhile
+        with self.lock:
+            staged['retry'] = None
+            if not staged['uploading'] and not staged['deleted'] and not staged['refs'] \
+                    and staged['version'] != staged['uploaded']:
+                self._schedule(staged)
+
+    def _upload(self, staged):
+        # runs in self.uploads: send a released staging file, then drop it unless it was written again meanwhile
+        with self.lock:
+            version, path, replaces = staged['version'], staged['path'], staged['replaces']
+        parent, name = os.path.split(path)
+        node = self.x115.path[parent]
+        f = None
+        try:
+            if not node:
+                raise IOError('directory is gone')
+            f = self.x115.upload(staged['name'], node.cid, name)
+            if f is None:
+                raise IOError('rejected')
+            if replaces and replaces != f.fid:
+                self.x115.rm_batch(node.cid, [replaces])
+            with self.lock:
+                deleted, moved = staged['deleted'], staged['path']
+            if deleted:
+                self.x115.rm_batch(node.cid, [f.fid])
+            elif moved != path:
+                self._move(f, path, moved, source=node.cid)
+        except Exception as e:
+            with self.lock:
+                staged['uploading'] = False
+                staged['error'] = e
+                staged['attempts'] += 1
+                delay = min(self.upload_backoff * 2 ** (staged['attempts'] - 1), self.upload_backoff_max)
+                if staged['deleted'] and not staged['refs']:
+                    self._discard(staged)
+                elif not staged['deleted'] and not staged['refs']:  # open handles upload again on release
+                    staged['retry'] = threading.Timer(delay, self._retry, (staged,))
+                    staged['retry'].daemon = True
+                    staged['retry'].start()
+            log.error('upload of %s failed, kept in %s, retrying in %gs: %s', path, staged['name'], delay, e)
+            stats.inc('upload_errors_total')
+            return
+        with self.lock:
+            staged['uploading'] = False
+            staged['uploaded'] = version
+            staged['replaces'] = f.fid
+            staged['error'] = None
+            staged['attempts'] = 0
+            if staged['deleted']:
+                if not staged['refs']:
+                    self._discard(staged)
+            elif staged['version'] != version:  # written again while uploading
+                if not staged['refs']:
+                    self._schedule(staged)
+            elif not staged['refs']:
+                self._forget(staged)
 
     def flush(self, path, fh):
         self.log('flush', path, fh)
-        f = self.fd[fh]['buffer']
-        f.flush()
-        # raise FuseOSError(errno.EROFS)
+        # blocks are complete files in self.cache, nothing to flush
+        # written files are uploaded on release, close(2) reports when their last upload failed
+        staged = self.fd.get(fh, {}).get('staged')
+        if staged and staged['error']:
+            raise FuseOSError(errno.EIO)
 
     def fsync(self, path, fdatasync, fh):
         self.log('fsync', path, fdatasync, fh)
-        raise FuseOSError(errno.EROFS)
-
-
-def main(mountpoint):
-    x115 = Connect115()
-    FUSE(X115FS(x115, buffer=10 * 1024 ** 2, tmp_dir='tmp', retain=10 * 60), mountpoint, nothreads=True, foreground=True, allow_other=True, fsname='115')
+        self._writable()
+        # upload now and wait for it, instead of on release
+        staged = self.fd.get(fh, {}).get('staged')
+        while staged:
+            with self.lock:
+                if staged['deleted'] or staged['version'] == staged['uploaded'] and not staged['uploading']:
+                    break
+                future = staged['future'] if staged['uploading'] else self._schedule(staged)
+            future.result()
+            if staged['error']:
+                raise FuseOSError(errno.EIO)
+
+
+def main(mountpoint, writable=False):
+    setup_logging(os.environ.get('LOG_LEVEL', 'INFO'))
+    x115 = Connect115(index='index.db')
+    FUSE(X115FS(x115, buffer=10 * 1024 ** 2, tmp_dir='tmp', retain=10 * 60, cache_size=10 * 1024 ** 3, readahead=8, connections=8,
+                writable=writable), mountpoint, foreground=True, allow_other=True, fsname='115')
 
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    main(sys.argv[1], 'rw' in sys.argv[2:])
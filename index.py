@@ -0,0 +1,54 @@
+import sqlite3
+import threading
+
+
+class Index(object):
+    def __init__(self, filename: str):
+        """
+        on-disk copy of Connect115.path, one row per file or directory
+        :param filename: sqlite database file, created if missing
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        # a cache of the remote tree: losing the last commits on power loss is fine, an fsync per listing is not
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS entry ('
+                            'path TEXT PRIMARY KEY, '
+                            'cid INTEGER, '  # directories only
+                            'fid INTEGER, '  # files only
+                            'pickcode TEXT, '
+                            'sha BLOB, '  # 20 raw bytes
+                            'size INTEGER, '
+                            'time INTEGER, '
+                            'fetched REAL, '  # when the entry was seen in its parent listing
+                            'listed REAL'  # when the directory content was fetched
+                            ')')
+
+    def load(self) -> list:
+        """
+        read all entries, parents always come before their children
+        :return: list of tuple: (path, cid, fid, pickcode, sha, size, time, fetched, listed)
+        """
+        with self.lock:
+            return self.db.execute('SELECT path, cid, fid, pickcode, sha, size, time, fetched, listed '
+                                   'FROM entry ORDER BY path').fetchall()
+
+    def save(self, rows: list, removed: list = ()):
+        """
+        store a directory listing in one transaction
+        :param rows: list of tuple in the same order as load
+        :param removed: abs paths gone from the listing, their children are removed too
+        """
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            for path in removed:
+                prefix = path.rstrip('/') + '/'
+                # children sort between prefix and prefix with '/' bumped to '0', a range on the primary key
+                self.db.execute('DELETE FROM entry WHERE path = ? OR (path > ? AND path < ?)',
+                                (path, prefix, prefix[:-1] + '0'))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
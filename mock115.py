@@ -0,0 +1,487 @@
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import socketserver
+import http.server
+import urllib.parse
+
+
+class Tree(object):
+    def __init__(self, dirs: int = 10, files: int = 100, depth: int = 4, file_size: int = 64 * 1024 ** 2):
+        """
+        synthetic directory tree computed from ids, nothing is stored so it can hold millions of entries
+        every directory above depth has dirs sub directories and files files
+        cid of the i-th sub directory of c is c * dirs + i + 1, root is 0
+        :param file_size: bytes per file
+        """
+        self.dirs = dirs
+        self.files = files
+        self.depth = depth
+        self.file_size = file_size
+        self.time = int(time.time())
+        self.clock = self.time  # ptime of added entries, newer than every computed one
+        self.created = set()  # cids of added folders, they stay empty
+        self.changed = {}  # cid=(added entries newest first, removed names)
+
+    def level(self, cid: int) -> int:
+        level = 0
+        while cid:
+            cid = (cid - 1) // self.dirs
+            level += 1
+        return level
+
+    def exists(self, cid: int) -> bool:
+        return cid == 0 or cid in self.created or (self.dirs > 0 and 0 < cid and self.level(cid) <= self.depth)
+
+    def count(self, cid: int) -> int:
+        if cid in self.changed or cid in self.created:
+            return len(self.listing(cid))
+        return (self.dirs if self.level(cid) < self.depth else 0) + self.files
+
+    def subdirs(self, cid: int) -> range:
+        if self.level(cid) >= self.depth:
+            return range(0)
+        return range(cid * self.dirs + 1, cid * self.dirs + self.dirs + 1)
+
+    def entries(self, cid: int, offset: int, limit: int) -> list:
+        """
+        children of cid as the webapi lists them: folders first, newest first
+        """
+        if cid in self.changed or cid in self.created:
+            return self.listing(cid)[offset:offset + limit]
+        subdirs = self.subdirs(cid)
+        data = [self.dir_entry(i) for i in subdirs[offset:offset + limit]]
+        start = max(offset - len(subdirs), 0)
+        end = max(offset + limit - len(subdirs), 0)
+        data.extend(self.file_entry(cid, j) for j in range(start, min(end, self.files)))
+        return data
+
+    def listing(self, cid: int) -> list:
+        # all children of a changed folder, built in full
+        added, removed = self.changed.get(cid, ([], set()))
+        dirs, files = [], []
+        if cid not in self.created:
+            dirs = [self.dir_entry(i) for i in self.subdirs(cid)]
+            files = [self.file_entry(cid, j) for j in range(self.files)]
+        dirs = [i for i in added if 's' not in i] + dirs
+        files = [i for i in added if 's' in i] + files
+        return [i for i in dirs + files if i['n'] not in removed]
+
+    def add(self, cid: int, name: str, folder: bool = False) -> dict:
+        """
+        add an entry to the listing of cid, newer than any other, as offline downloads do
+        added files are listed only, the cdn does not serve them; added folders are empty
+        """
+        self.clock += 1
+        t = str(self.clock)
+        if folder:
+            new = 3 * 10 ** 15 + self.clock
+            self.created.add(new)
+            entry = {'cid': str(new), 'pid': str(cid), 'aid': '1', 'n': name, 'pc': f'd{new}', 't': t, 'te': t, 'tp': t}
+        else:
+            fid = 4 * 10 ** 15 + self.clock
+            entry = {'fid': str(fid), 'cid': str(cid), 'n': name, 's': self.file_size, 'pc': f'a{fid}',
+                     'sha': hashlib.sha1(name.encode()).hexdigest().upper(), 't': t, 'te': t, 'tp': t}
+        added, removed = self.changed.setdefault(cid, ([], set()))
+        added.insert(0, entry)
+        removed.discard(name)
+        return entry
+
+    def remove(self, cid: int, name: str):
+        """
+        drop an entry from the listing of cid
+        """
+        added, removed = self.changed.setdefault(cid, ([], set()))
+        added[:] = [i for i in added if i['n'] != name]
+        removed.add(name)
+
+    def dir_entry(self, cid: int) -> dict:
+        t = str(self.time - cid % 86400)
+        return {'cid': str(cid), 'pid': str((cid - 1) // self.dirs), 'aid': '1', 'n': f'dir{cid}', 'pc': f'd{cid}',
+                't': t, 'te': t, 'tp': t}
+
+    def file_entry(self, cid: int, j: int) -> dict:
+        pickcode = self.pickcode(cid, j)
+        t = str(self.time - j)
+        fid = 10 ** 15 + cid * self.files + j  # file and folder ids share one space on 115
+        return {'fid': str(fid), 'cid': str(cid), 'n': f'file{j}.bin', 's': self.file_size,
+                'pc': pickcode, 'sha': hashlib.sha1(pickcode.encode()).hexdigest().upper(), 't': t, 'te': t, 'tp': t}
+
+    @staticmethod
+    def pickcode(cid: int, j: int) -> str:
+        return f'f{cid}x{j}'
+
+    def valid(self, pickcode: str) -> bool:
+        try:
+            cid, j = map(int, pickcode[1:].split('x'))
+        except ValueError:
+            return False
+        return pickcode[0] == 'f' and self.exists(cid) and 0 <= j < self.files
+
+
+class Content(object):
+    period = 251  # prime, so consecutive files and blocks do not line up
+
+    def __init__(self):
+        """
+        file content, byte o of a file is (o + seed) % period where seed comes from the pickcode
+        """
+        self.pattern = bytes(i % self.period for i in range(self.period * 1024))
+
+    def seed(self, pickcode: str) -> int:
+        return int(hashlib.sha1(pickcode.encode()).hexdigest()[:8], 16) % self.period
+
+    def read(self, pickcode: str, offset: int, length: int) -> bytes:
+        # length is at most len(self.pattern) - self.period
+        i = (offset + self.seed(pickcode)) % self.period
+        return self.pattern[i:i + length]
+
+    def expect(self, pickcode: str, offset: int, length: int) -> bytes:
+        """
+        what a client should get for a range, for checking downloads
+        """
+        chunks = []
+        while length > 0:
+            n = min(length, len(self.pattern) - self.period)
+            chunks.append(self.read(pickcode, offset, n))
+            offset += n
+            length -= n
+        return b''.join(chunks)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real api and cdn
+    disable_nagle_algorithm = True  # headers and body are separate writes
+    server_version = 'mock115'
+    mock = None  # Mock, set by Mock.start
+
+    def log_message(self, format, *args):
+        if self.mock.verbose:
+            super().log_message(format, *args)
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length)
+        if self.path.startswith('/upload'):  # raw file content
+            return self.handle_request()
+        self.handle_request(dict(urllib.parse.parse_qsl(self.body.decode())))
+
+    def handle_request(self, form=None):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        query.update(form or {})
+        mock = self.mock
+        mock.count(url.path)
+        if mock.latency:
+            time.sleep(random.uniform(0.5, 1.5) * mock.latency)
+        if mock.error_rate and random.random() < mock.error_rate:
+            return self.reply(503, {'state': False, 'error': 'injected'})
+        if url.path.startswith('/cdn/'):
+            return self.cdn(url.path[5:], query)
+        route = mock.routes.get(url.path)
+        if url.path == '/':
+            route = mock.routes.get('/?ac=' + query.get('ac', ''))
+        elif url.path == '/web/lixian/':
+            route = mock.routes.get('/web/lixian/?ac=' + query.get('ac', ''))
+        if route is None:
+            return self.reply(404, {'state': False, 'error': 'not found'})
+        route(self, query)
+
+    def reply(self, status: int, result: dict, headers: dict = None):
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def cdn(self, pickcode: str, query: dict):
+        mock = self.mock
+        uploaded = mock.uploaded.get(pickcode)
+        if uploaded is None and not mock.tree.valid(pickcode):
+            return self.reply(404, {})
+        if int(query.get('t', 0)) < time.time():
+            return self.reply(403, {})
+        size = mock.tree.file_size if uploaded is None else len(uploaded)
+        start, end = 0, size - 1
+        status = 200
+        r = self.headers.get('Range')
+        if r and r.startswith('bytes='):
+            first, _, last = r[6:].partition('-')
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end + 1 - start))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        offset, chunk = start, 64 * 1024
+        began = time.monotonic()
+        while offset <= end:
+            n = min(chunk, end + 1 - offset)
+            self.wfile.write(mock.content.read(pickcode, offset, n) if uploaded is None else uploaded[offset:offset + n])
+            offset += n
+            mock.count('cdn_bytes', n)
+            if mock.bandwidth:  # per connection
+                ahead = (offset - start) / mock.bandwidth - (time.monotonic() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    # api endpoints
+    # =============
+
+    def files(self, query):
+        cid = int(query.get('cid', 0))
+        tree = self.mock.tree
+        if not tree.exists(cid):
+            return self.reply(200, {'state': False, 'errNo': 20130827, 'error': 'folder not found'})
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 115))
+        self.reply(200, {'state': True, 'errNo': 0, 'error': '', 'cid': cid, 'count': tree.count(cid),
+                         'offset': offset, 'limit': limit, 'data': tree.entries(cid, offset, limit)})
+
+    def natsort(self, query):
+        cid = int(query.get('cid', 0))
+        tree = self.mock.tree
+        if not tree.exists(cid):
+            return self.reply(200, {'state': False, 'errNo': 20130827, 'error': 'folder not found'})
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 50))
+        subdirs = tree.subdirs(cid)
+        self.reply(200, {'state': True, 'errNo': 0, 'count': len(subdirs),
+                         'data': [tree.dir_entry(i) for i in subdirs[offset:offset + limit]]})
+
+    def download(self, query):
+        mock = self.mock
+        pickcode = query.get('pickcode', '')
+        uploaded = mock.uploaded.get(pickcode)
+        if uploaded is None and not mock.tree.valid(pickcode):
+            return self.reply(200, {'state': False, 'msg_code': 70005, 'msg': 'file not found'})
+        expires = int(time.time() + mock.link_ttl)
+        url = f'{mock.hosts["cdn"]}/cdn/{pickcode}?t={expires}&u=mock'
+        self.reply(200, {'state': True, 'msg': '', 'msg_code': 0, 'pickcode': pickcode,
+                         'file_size': str(mock.tree.file_size if uploaded is None else len(uploaded)), 'file_url': url},
+                   headers={'Set-Cookie': f'mock={pickcode}; path=/'})
+
+    def index_info(self, query):
+        self.reply(200, {'state': True, 'data': {'space_info': {'all_remain': {'size': 2 * 1024 ** 4},
+                                                                'all_total': {'size': 3 * 1024 ** 4}}}})
+
+    def space(self, query):
+        self.reply(200, {'state': True, 'sign': 'mocksign', 'time': int(time.time())})
+
+    def task_lists(self, query):
+        mock = self.mock
+        per_page = 30
+        page = int(query.get('page', 1))
+        page_count = max((mock.tasks - 1) // per_page + 1, 1)
+        tasks = [{'info_hash': hashlib.sha1(str(i).encode()).hexdigest(), 'name': f'task{i}', 'add_time': mock.tree.time - i,
+                  'last_update': int(time.time()) if i < mock.active else mock.tree.time - i,
+                  'percentDone': 50 if i < mock.active else 100, 'status': 1 if i < mock.active else 2,
+                  'size': mock.tree.file_size, 'peers': 0, 'rateDownload': 0, 'left_time': 0, 'file_id': '',
+                  'move': 0, 'url': f'magnet:?xt=urn:btih:{i}', 'del_path': ''}
+                 for i in range((page - 1) * per_page, min(page * per_page, mock.tasks))]
+        self.reply(200, {'state': True, 'errtype': 'suc', 'errno': 0, 'page': page, 'page_count': page_count,
+                         'count': mock.tasks, 'tasks': tasks})
+
+    def add_task_url(self, query):
+        self.reply(200, {'state': True, 'errno': 0, 'errtype': 'suc', 'errcode': 0, 'name': '', 'url': query.get('url'),
+                         'info_hash': hashlib.sha1(query.get('url', '').encode()).hexdigest()})
+
+    def add_task_urls(self, query):
+        urls = [v for k, v in sorted(query.items()) if k.startswith('url[')]
+        self.reply(200, {'state': True, 'errno': 0, 'errtype': 'suc', 'errcode': 0,
+                         'result': [{'state': True, 'errno': 0, 'errtype': 'suc', 'errcode': 0, 'url': url, 'name': '',
+                                     'info_hash': hashlib.sha1(url.encode()).hexdigest()} for url in urls]})
+
+    def initupload(self, query):
+        mock = self.mock
+        sha, size = query.get('fileid', '').upper(), int(query.get('filesize', 0))
+        content = mock.contents.get(sha)
+        if content is None or len(content) != size:  # unknown, ask for the bytes
+            target = urllib.parse.quote(query.get('target', ''))
+            return self.reply(200, {'status': 1, 'statuscode': 0, 'upload_url': f'{mock.hosts["upload"]}/upload?sha={sha}&target={target}'})
+        if 'sign_key' not in query:  # known, ask for the sha1 of a range to prove it
+            start = random.randrange(size) if size else 0
+            end = max(min(start + 128 * 1024, size) - 1, start)
+            key = hashlib.sha1(f'{sha}{start}{random.random()}'.encode()).hexdigest()
+            with mock.lock:
+                mock.signs[key] = (start, end)
+            return self.reply(200, {'status': 7, 'statuscode': 701, 'sign_key': key, 'sign_check': f'{start}-{end}'})
+        with mock.lock:
+            start, end = mock.signs.pop(query['sign_key'], (0, -1))
+        if hashlib.sha1(content[start:end + 1]).hexdigest().upper() != query.get('sign_val', '').upper():
+            return self.reply(200, {'status': 0, 'statuscode': 402, 'statusmsg': 'sign check failed'})
+        fid, pickcode = mock.store(content)
+        self.reply(200, {'status': 2, 'statuscode': 0, 'statusmsg': '', 'fileid': str(fid), 'pickcode': pickcode})
+
+    def upload(self, query):
+        body = self.body
+        sha = hashlib.sha1(body).hexdigest().upper()
+        if sha != query.get('sha', '').upper():
+            return self.reply(200, {'state': False, 'message': 'sha1 mismatch'})
+        self.mock.count('upload_bytes', len(body))
+        fid, pickcode = self.mock.store(body)
+        self.reply(200, {'state': True, 'data': {'file_id': str(fid), 'pick_code': pickcode, 'sha1': sha, 'file_size': len(body)}})
+
+    def ok(self, query):
+        # move, rename, delete: accepted, the synthetic tree does not change
+        self.reply(200, {'state': True, 'error': '', 'errno': ''})
+
+    def add(self, query):
+        cid = random.randrange(10 ** 15, 10 ** 16)
+        self.reply(200, {'state': True, 'error': '', 'errno': '', 'aid': 1, 'cid': str(cid), 'cname': query.get('cname'),
+                         'file_id': str(cid), 'file_name': query.get('cname')})
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # clients drop cdn downloads they no longer need
+            super().handle_error(request, client_address)
+
+
+class Mock(object):
+    routes = {'/files': Handler.files,
+              '/natsort/files.php': Handler.natsort,
+              '/files/download': Handler.download,
+              '/files/index_info': Handler.index_info,
+              '/files/move': Handler.ok,
+              '/files/edit': Handler.ok,
+              '/files/batch_rename': Handler.ok,
+              '/files/add': Handler.add,
+              '/3.0/initupload.php': Handler.initupload,
+              '/upload': Handler.upload,
+              '/rb/delete': Handler.ok,
+              '/?ac=space': Handler.space,
+              '/web/lixian/?ac=task_lists': Handler.task_lists,
+              '/web/lixian/?ac=add_task_url': Handler.add_task_url,
+              '/web/lixian/?ac=add_task_urls': Handler.add_task_urls}
+
+    def __init__(self, tree: Tree, latency: float = 0, bandwidth: float = 0, error_rate: float = 0,
+                 link_ttl: int = 3600, tasks: int = 100, active: int = 10, verbose: bool = False):
+        """
+        local stand-in for the 115 api hosts and cdn
+        :param latency: mean seconds added before every response, jittered by +-50%
+        :param bandwidth: bytes per second per cdn connection, 0 for unlimited
+        :param error_rate: share of requests answered with 503
+        :param link_ttl: seconds download links stay valid, the cdn answers 403 after
+        :param tasks: offline tasks listed by task_lists, newest first
+        :param active: newest tasks still downloading, their last_update is always now
+        """
+        self.tree = tree
+        self.content = Content()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.link_ttl = link_ttl
+        self.tasks = tasks
+        self.active = active
+        self.verbose = verbose
+        self.hosts = {}
+        self.servers = []
+        self.lock = threading.Lock()
+        self.counts = {}  # path=requests, cdn_bytes=bytes sent, upload_bytes=bytes received
+        self.contents = {}  # sha1=content of uploaded files, kept in memory
+        self.uploaded = {}  # pickcode=content, served by the cdn
+        self.signs = {}  # sign_key=(start, end) asked by initupload
+        self.fid = 2 * 10 ** 15
+
+    def store(self, content: bytes) -> tuple:
+        """
+        keep an uploaded file, each upload is a new file with its own id even for known content
+        :return: (fid, pickcode)
+        """
+        with self.lock:
+            self.fid += 1
+            pickcode = f'u{self.fid}'
+            self.contents[hashlib.sha1(content).hexdigest().upper()] = content
+            self.uploaded[pickcode] = content
+            return self.fid, pickcode
+
+    def count(self, key: str, n: int = 1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def start(self, host: str = '127.0.0.1', port: int = 8115) -> dict:
+        """
+        serve webapi, aps, 115, cdn and upload on five consecutive ports, in background threads
+        :return: family=base url, as x115.hosts takes them
+        """
+        handler = type('Handler', (Handler,), {'mock': self})
+        for i, family in enumerate(('webapi', 'aps', '115', 'cdn', 'upload')):
+            server = Server((host, port + i if port else 0), handler)
+            self.servers.append(server)
+            self.hosts[family] = f'http://{host}:{server.server_address[1]}'
+            threading.Thread(target=server.serve_forever, name=f'mock-{family}', daemon=True).start()
+        return {k: v for k, v in self.hosts.items() if k != 'cdn'}
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+
+def options(parser: argparse.ArgumentParser):
+    parser.add_argument('--dirs', type=int, default=10, help='sub directories per directory')
+    parser.add_argument('--files', type=int, default=100, help='files per directory')
+    parser.add_argument('--depth', type=int, default=4, help='directory levels below root')
+    parser.add_argument('--file-size', type=int, default=64 * 1024 ** 2, help='bytes per file')
+    parser.add_argument('--latency', type=float, default=0, help='mean seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, default=0, help='cdn bytes per second per connection, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests failed with 503')
+    parser.add_argument('--link-ttl', type=int, default=3600, help='seconds before download links expire')
+    parser.add_argument('--tasks', type=int, default=100, help='offline tasks')
+    parser.add_argument('--active-tasks', type=int, default=10, help='offline tasks still downloading')
+
+
+def from_options(args, verbose: bool = False) -> Mock:
+    tree = Tree(args.dirs, args.files, args.depth, args.file_size)
+    return Mock(tree, latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                link_ttl=args.link_ttl, tasks=args.tasks, active=args.active_tasks, verbose=verbose)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='mock 115 api and cdn')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8115, help='first of five ports: webapi, aps, 115, cdn, upload')
+    options(parser)
+    args = parser.parse_args(argv)
+    mock = from_options(args, verbose=True)
+    hosts = mock.start(args.host, args.port)
+    print(f"X115_HOSTS='{json.dumps(hosts)}'")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,155 @@
+import time
+import random
+import threading
+import urllib.parse
+import requests
+from stats import stats
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, burst: float = 1):
+        """
+        allow rate calls per second on average and up to burst at once, over all threads
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        take a token
+        :return: seconds to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveLimit(object):
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64):
+        """
+        concurrency limit with additive increase on success and multiplicative decrease on failure
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        with self.cond:
+            if self.inflight < int(self.limit):
+                self.inflight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, ok: bool):
+        with self.cond:
+            self.inflight -= 1
+            if ok:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(self.minimum, self.limit / 2)
+            self.cond.notify_all()
+
+
+class Scheduler(object):
+    families = {'webapi.115.com': 'webapi', 'aps.115.com': 'aps', '115.com': '115', 'uplb.115.com': 'upload'}
+
+    def __init__(self, session: requests.Session, rates: dict = None, concurrency: int = 8,
+                 timeout: tuple = (5, 30), retries: int = 3, backoff: float = 0.5, families: dict = None):
+        """
+        single path for every 115 api call: per family rate limit, adaptive concurrency, timeout and retries
+        :param session: pooled requests session
+        :param rates: family=(requests per second, burst)
+        :param concurrency: initial concurrent requests per family, adapted to failures
+        :param timeout: (connect, read) seconds
+        :param retries: extra attempts after throttling, server errors and connection errors
+        :param backoff: base seconds of the jittered exponential backoff
+        :param families: host[:port]=family, defaults to the 115 hosts
+        """
+        self.s = session
+        if families:
+            self.families = families
+        rates = rates or {'webapi': (10, 20), 'aps': (5, 10), '115': (2, 5), 'upload': (2, 5)}
+        self.buckets = {k: TokenBucket(*v) for k, v in rates.items()}
+        self.limits = {k: AdaptiveLimit(concurrency) for k in rates}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def family(self, url: str) -> str:
+        return self.families.get(urllib.parse.urlsplit(url).netloc, '115')
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        # host and path, the query carries ids and timestamps
+        url = urllib.parse.urlsplit(url)
+        return url.hostname + url.path
+
+    def delay(self, attempt: int) -> float:
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def failed(status: int) -> bool:
+        # throttled or broken, worth backing off and retrying
+        return status == 429 or status >= 500
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        same as requests.Session.request, scheduled
+        GETs are retried on any connection error, other methods only when the request was not sent
+        """
+        family = self.family(url)
+        endpoint = self.endpoint(url)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            self.buckets[family].wait()
+            self.limits[family].acquire()
+            ok, r = False, None
+            if hasattr(kwargs.get('data'), 'seek'):  # file body, send it again from the start
+                kwargs['data'].seek(0)
+            start = time.perf_counter()
+            try:
+                r = self.s.request(method, url, **kwargs)
+                ok = not self.failed(r.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                retry = method == 'GET' or isinstance(e, requests.ConnectTimeout)
+                if not retry or attempt == self.retries:
+                    raise
+            finally:
+                self.limits[family].release(ok)
+                self.record(endpoint, time.perf_counter() - start, ok)
+            if r is not None:
+                retry = method == 'GET' or r.status_code in (429, 503)  # not processed, safe to send again
+                if ok or not retry or attempt == self.retries:
+                    return r
+            time.sleep(self.delay(attempt))
+
+    @staticmethod
+    def record(endpoint: str, seconds: float, ok: bool):
+        stats.observe('api_seconds', seconds, endpoint=endpoint)
+        if not ok:
+            stats.inc('api_errors_total', endpoint=endpoint)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
@@ -1,54 +1,249 @@
+import os
+import re
 import sys
+import json
+import asyncio
+import logging
+import threading
+import itertools
+import collections
+import email.utils
+import functools
+import mimetypes
+import concurrent.futures
 # from urllib.parse import urlparse
 from datetime import datetime
 from sanic import Sanic  # pip install sanic
 from sanic import response
 from sanic_jinja2 import SanicJinja2  # pip install sanic-jinja2
 from x115 import Connect115
+from ax115 import AsyncConnect115
+from cache import BlockCache
+from download import Downloader
+from stats import stats, setup_logging
 
+log = logging.getLogger(__name__)
 app = Sanic()
 jinja = SanicJinja2(app)
-x115 = Connect115()
+x115 = Connect115(index='index.db')
+ax115 = AsyncConnect115(x115)  # shares the path cache, never blocks the event loop
 port = 8001
+proxy = None  # set by enable_proxy: files are streamed through the block cache instead of redirected
+rendered = collections.OrderedDict()  # (cid, format)=(gen, body), least recently used first
+rendered_max = 256  # listings kept rendered
+stream_threshold = 5000  # listings with more entries are streamed, not cached
+content_types = {'html': 'text/html; charset=utf-8', 'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+
+
+def enable_proxy(block_size=10 * 1024 ** 2, cache_dir='tmp_server', cache_size=10 * 1024 ** 3, connections=8):
+    """
+    serve files from a local BlockCache filled by parallel range requests, same as fs.py
+    """
+    global proxy
+    proxy = {
+        'cache': BlockCache(cache_dir, block_size, cache_size),
+        'downloader': Downloader(x115.s, connections, part_size=max(block_size // connections, 1024 ** 2)),
+        # blocking cache reads, a cold block holds its worker for the whole download so cached reads need spare ones
+        'pool': concurrent.futures.ThreadPoolExecutor(max_workers=connections * 4),
+        'ahead': concurrent.futures.ThreadPoolExecutor(max_workers=connections)  # read-ahead, apart from reads
+    }
+
+
+def http_date(t):
+    return datetime.utcfromtimestamp(t).strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+
+def not_modified(request, etag, modified):
+    match = request.headers.get('If-None-Match')
+    if match is not None:  # takes precedence over If-Modified-Since
+        return match.strip() == '*' or etag in [i.strip() for i in match.split(',')]
+    since = request.headers.get('If-Modified-Since')
+    if since:
+        try:
+            return email.utils.parsedate_to_datetime(since).timestamp() >= int(modified)
+        except (TypeError, ValueError):
+            pass
+    return False
+
+
+def entry(name, v):
+    if v.is_dir:
+        return {'name': name, 'dir': True, 'time': v.time, 'cid': str(v.cid)}
+    return {'name': name, 'dir': False, 'time': v.time, 'size': v.size, 'fid': str(v.fid), 'pickcode': v.pickcode, 'sha': v.sha.hex()}
+
+
+def render(fmt, root, ls):
+    # listing as a sequence of str pieces
+    if fmt == 'html':
+        return jinja.env.get_template('ls.html').generate(root=root, ls=ls)
+    if fmt == 'ndjson':
+        return (json.dumps(entry(k, v), ensure_ascii=False) + '\n' for k, v in ls.items())
+    return itertools.chain('[', (('' if i == 0 else ',') + json.dumps(entry(k, v), ensure_ascii=False) for i, (k, v) in enumerate(ls.items())), ']')
+
+
+def batched(pieces, size=64 * 1024):
+    buf, n = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        n += len(piece)
+        if n >= size:
+            yield ''.join(buf).encode()
+            buf, n = [], 0
+    if buf:
+        yield ''.join(buf).encode()
+
+
+def listing(request, root, node):
+    # directory page or json, cached per directory generation and answering conditional GETs
+    fmt = request.args.get('format', 'html')
+    if fmt not in content_types:
+        fmt = 'html'
+    gen = node.gen
+    headers = {'ETag': f'"{node.cid}.{gen}.{fmt}"', 'Last-Modified': http_date(gen / 1e6), 'Cache-Control': 'no-cache'}
+    if not_modified(request, headers['ETag'], gen / 1e6):
+        return response.raw(b'', status=304, headers=headers)
+    key = (node.cid, fmt)
+    cached = rendered.get(key)
+    if cached and cached[0] == gen:
+        rendered.move_to_end(key)
+        return response.raw(cached[1], headers=headers, content_type=content_types[fmt])
+    with x115.path.lock:  # children and generation must match
+        gen = node.gen
+        ls = dict(node.children)
+    headers['ETag'] = f'"{node.cid}.{gen}.{fmt}"'
+    headers['Last-Modified'] = http_date(gen / 1e6)
+    if fmt == 'ndjson' or len(ls) > stream_threshold:
+        async def body(resp):
+            for chunk in batched(render(fmt, root, ls)):
+                await resp.write(chunk)
+        return response.stream(body, headers=headers, content_type=content_types[fmt])
+    body = b''.join(batched(render(fmt, root, ls)))
+    rendered[key] = (gen, body)
+    if len(rendered) > rendered_max:
+        rendered.popitem(last=False)
+    return response.raw(body, headers=headers, content_type=content_types[fmt])
+
+
+def parse_range(header, size):
+    """
+    :return: (start, end) inclusive, None to serve the whole file, False if unsatisfiable
+    """
+    m = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not m or m.group(1) == m.group(2) == '':  # absent, malformed or multiple ranges
+        return None
+    if m.group(1) == '':  # suffix: last n bytes
+        start, end = max(size - int(m.group(2)), 0), size - 1
+    else:
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def stream(request, node):
+    # answer a possibly ranged GET from the block cache
+    cache, block = proxy['cache'], proxy['cache'].block_size
+    key = node.sha.hex() or node.pickcode
+    headers = {'Accept-Ranges': 'bytes', 'ETag': f'"{key}"', 'Last-Modified': http_date(node.time)}
+    start, end, status = 0, node.size - 1, 200
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range in (headers['ETag'], headers['Last-Modified']):
+        r = parse_range(request.headers.get('Range'), node.size)
+        if r is False:
+            return response.raw(b'', status=416, headers={'Content-Range': f'bytes */{node.size}'})
+        if r:
+            (start, end), status = r, 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{node.size}'
+    headers['Content-Length'] = str(end - start + 1)
+    link = functools.partial(x115.get_link, node.pickcode)
+
+    def fetch(blk, cancel=None):
+        offset = blk * block
+        return functools.partial(proxy['downloader'].fetch, link, {'Accept-Encoding': '*'}, offset, min(block, node.size - offset),
+                                 cancel=cancel)
+
+    def ahead_done(future):
+        e = None if future.cancelled() else future.exception()
+        if e and not isinstance(e, (asyncio.CancelledError, concurrent.futures.CancelledError)):
+            log.warning('read-ahead of %s failed: %s', node.pickcode, e)
+
+    async def body(resp):
+        loop = asyncio.get_event_loop()
+        offset, ahead = start, None
+        gone = threading.Event()  # the client went away, read-ahead parts stop
+        try:
+            while offset <= end:
+                blk, o = divmod(offset, block)
+                if ahead != blk + 1 and (blk + 1) * block < node.size:  # keep the next block coming while this one is sent
+                    ahead = blk + 1
+                    future = loop.run_in_executor(proxy['ahead'], cache.load, key, ahead, fetch(ahead, gone))
+                    future.add_done_callback(ahead_done)
+                n = min(end + 1 - offset, block - o, 1024 ** 2)
+                await resp.write(await loop.run_in_executor(proxy['pool'], cache.read, key, blk, o, n, fetch(blk)))
+                stats.inc('served_bytes_total', n)
+                offset += n
+        finally:
+            if offset <= end:
+                gone.set()
+    content_type = mimetypes.guess_type(request.path)[0] or 'application/octet-stream'
+    return response.stream(body, status=status, headers=headers, content_type=content_type, chunked=False)
+
+
+@app.route('/metrics')
+async def metrics(request):
+    # on any host but my.115.com, where every path is a 115 path
+    return response.text(stats.render(), content_type='text/plain; version=0.0.4')
 
 
 @app.route(r"/<full_path:[\w/\W]*>", methods=('GET', 'HEAD'), host=f"my.115.com:{port}")
-@jinja.template('ls.html')
 async def ls(request, full_path):
     full_path = '/' + full_path.strip()
     if full_path == 'favicon.ico':
         return response.raw(b'')
-    print(request.headers, full_path)
-    ls = x115.path[full_path]
-    if not ls or len(ls) <= 2:
-        ls = x115.listdir(full_path)
+    log.debug('%s %s %s', request.method, full_path, request.headers)
+    node = await ax115.load(full_path)  # served from cache once seen, loads parents of unknown paths
     if request.method == "HEAD":
         code = 200
-        if not ls:
+        mod_time = ''
+        if not node:
             code = 404
             size = 0
         else:
-            size = ls.get('size', 0)
-            mod_time = datetime.utcfromtimestamp(ls['time']).strftime('%a, %d %b %Y %H:%M:%S GMT')
-        return response.raw(b'', headers={'Content-Length': size, 'Last-Modified': mod_time}, status=code)
-    if 'pickcode' in ls:
-        r = x115._get_link(ls['pickcode'])
-        url = r.json()['file_url']
-        cookie = r.headers.get('Set-Cookie')
+            size = 0 if node.is_dir else node.size
+            mod_time = http_date(node.time)
+        headers = {'Content-Length': size, 'Last-Modified': mod_time}
+        if proxy and node and not node.is_dir:
+            headers['Accept-Ranges'] = 'bytes'
+        return response.raw(b'', headers=headers, status=code)
+    if not node:
+        return response.text('Not Found', status=404)
+    if not node.is_dir and proxy:
+        return stream(request, node)
+    if not node.is_dir:
+        url, cookie = await ax115.link(node.pickcode)
         # if cookie:
         #     cookie = cookie.replace('domain=115.com', 'domain=' + urlparse(url).netloc)
         #     cookie = cookie.split(';', 1)[0] + '; domain=' + urlparse(url).netloc
-        return response.redirect(url.replace('http://', 'https://'), headers={'Set-Cookie': cookie})
+        return response.redirect(url, headers={'Set-Cookie': cookie})
     else:
-        return {'root': full_path, 'ls': ls}
+        return listing(request, full_path, node)
+
+
+@app.listener('after_server_stop')
+async def close(app, loop):
+    await ax115.close()
 
 
 if __name__ == "__main__":
+    setup_logging(os.environ.get('LOG_LEVEL', 'INFO'))
     host = '127.0.0.1'
     port = 8001
     try:
         host = sys.argv[1]
         port = sys.argv[2]
+        if sys.argv[3] == 'proxy':
+            enable_proxy()
     except:
         pass
     app.run(host=host, port=port)
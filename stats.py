@@ -0,0 +1,84 @@
+import queue
+import bisect
+import logging
+import threading
+import logging.handlers
+
+
+class Stats(object):
+    # latency bucket upper bounds in seconds, 0.5 ms doubling up to ~16 s
+    bounds = [0.0005 * 2 ** i for i in range(16)]
+
+    def __init__(self):
+        """
+        counters, gauges and latency histograms, keyed by name and labels
+        cheap enough to update on every FUSE operation
+        """
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels)=value
+        self.gauges = {}  # (name, labels)=value
+        self.histograms = {}  # (name, labels)=[bucket counts..., sum, count]
+
+    def inc(self, name: str, n: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def add(self, name: str, n: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + n
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self.bounds, seconds)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(self.bounds) + 3)
+            h[i] += 1  # index len(bounds) is +Inf
+            h[-2] += seconds
+            h[-1] += 1
+
+    def render(self) -> str:
+        """
+        :return: prometheus text exposition format
+        """
+        def fmt(name, labels, extra=()):
+            labels = ','.join(f'{k}="{v}"' for k, v in labels + tuple(extra))
+            return f'{name}{{{labels}}}' if labels else name
+
+        lines = []
+        with self.lock:
+            for (name, labels), v in sorted(self.counters.items()):
+                lines.append(f'{fmt(name, labels)} {v}')
+            for (name, labels), v in sorted(self.gauges.items()):
+                lines.append(f'{fmt(name, labels)} {v}')
+            for (name, labels), h in sorted(self.histograms.items()):
+                total = 0
+                for bound, n in zip(self.bounds + ['+Inf'], h):
+                    total += n
+                    lines.append(f'{fmt(name + "_bucket", labels, [("le", bound)])} {total}')
+                lines.append(f'{fmt(name + "_sum", labels)} {h[-2]}')
+                lines.append(f'{fmt(name + "_count", labels)} {h[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+stats = Stats()  # shared by x115, fs, server and the caches
+
+
+def setup_logging(level='INFO') -> logging.handlers.QueueListener:
+    """
+    log through a queue, records are formatted and written by a background thread
+    :param level: logging level name or number
+    :return: the started listener, stop it to flush
+    """
+    q = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(q, handler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    listener.start()
+    return listener
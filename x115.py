@@ -1,14 +1,28 @@
+import os
 import json
 import time
+import hashlib
 import functools
+import threading
+import itertools
 import collections
+import collections.abc
+import concurrent.futures
 import requests
+import requests.adapters
+import urllib.parse
 import sys
+import logging
+from index import Index
+from stats import stats
+from scheduler import Scheduler, TokenBucket
 if sys.platform == 'win32':
     import posixpath as ppath
 else:
     import os.path as ppath
 
+log = logging.getLogger(__name__)
+
 referer = {'webapi': 'https://webapi.115.com/bridge_2.0.html?namespace=Core.DataAccess&api=UDataAPI&_t=v5',
            'aps': 'https://aps.115.com/bridge_2.0.html?namespace=Core.DataAccess&api=DataAPSAPI&_t=v5',
            '115': 'https://115.com/?cid={}&offset=0&tab=download&mode=wangpan'
@@ -25,6 +39,14 @@ headers = {
 
 cookies = json.loads(open('cookie.json').read())
 
+# api base urls by family, X115_HOSTS='{"webapi": "http://127.0.0.1:8115", ...}' points them elsewhere, e.g. at mock115.py
+hosts = {'webapi': 'https://webapi.115.com',
+         'aps': 'https://aps.115.com',
+         '115': 'https://115.com',
+         'upload': 'https://uplb.115.com'
+         }
+hosts.update(json.loads(os.environ.get('X115_HOSTS', '{}')))
+
 origin = {'webapi': 'https://webapi.115.com',
           '115': 'https://115.com'
           }
@@ -34,32 +56,147 @@ content_type = {'api': 'application/x-www-form-urlencoded',
                 }
 
 
-class Connect115(object):
+class File(object):
+    __slots__ = ('time', 'size', 'fid', 'pickcode', 'sha')
+    is_dir = False
+
+    def __init__(self, time: int, size: int, fid: int, pickcode: str, sha: bytes):
+        """
+        file node of Connect115.path
+        :param sha: sha1 as 20 raw bytes
+        """
+        self.time = time
+        self.size = size
+        self.fid = fid
+        self.pickcode = pickcode
+        self.sha = sha
+
+    @classmethod
+    def parse(cls, i: dict):
+        return cls(int(i.get('te', i['t'])), int(i['s']), int(i['fid']), i['pc'], bytes.fromhex(i['sha']))
+
+    def update(self, other) -> bool:
+        changed = (self.time, self.size, self.fid, self.pickcode, self.sha) != (other.time, other.size, other.fid, other.pickcode, other.sha)
+        self.time = other.time
+        self.size = other.size
+        self.fid = other.fid
+        self.pickcode = other.pickcode
+        self.sha = other.sha
+        return changed
+
+
+class Dir(object):
+    __slots__ = ('time', 'cid', 'children', 'gen')
+    is_dir = True
+    _gen = 0
+    _gen_lock = threading.Lock()
+
+    def __init__(self, time: int, cid: int):
+        """
+        directory node of Connect115.path, children are kept apart from the metadata
+        gen versions the children: a strictly increasing microsecond timestamp of their last change
+        """
+        self.time = time
+        self.cid = cid
+        self.children = {}  # name=node
+        self.touch()
+
+    def touch(self):
+        with Dir._gen_lock:
+            Dir._gen = self.gen = max(int(time.time() * 1e6), Dir._gen + 1)
+
+    @classmethod
+    def parse(cls, i: dict):
+        return cls(int(i.get('te', i['t'])), int(i['cid']))
+
+    def update(self, other) -> bool:
+        changed = (self.time, self.cid) != (other.time, other.cid)
+        self.time = other.time
+        self.cid = other.cid
+        return changed
+
+
+class SingleFlight(object):
     def __init__(self):
         """
+        run one call per key at a time, concurrent callers with the same key share its result
+        """
+        self.lock = threading.Lock()
+        self.calls = {}  # key=concurrent.futures.Future
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            future = self.calls.get(key)
+            owner = future is None
+            if owner:
+                future = self.calls[key] = concurrent.futures.Future()
+        if not owner:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class Connect115(object):
+    def __init__(self, dir_ttl: int = 10 * 60, index: str = None):
+        """
+        :param dir_ttl: seconds a directory listing stays fresh, older listings are served while refreshed in background
+        :param index: optional sqlite file keeping self.path across restarts
         self.dirs: a copy of directory structure with directory id as key and name as value
         self._dirs_lookup: a copy of directories' parent paths
         self.path:
             {
-                "/": {
-                    "dir1": {
-                        "file1.ext": { "time": 12345, "size": 1048576, "pc": "abcde" },
-                        "file2.ext": { "time": 12346, "size": 1048576, "pc": "fghij" },
-                        "time": 11111
-                    },
-                    "dir2": {
-                        "dir3": {"time": 22222},
-                        "time": 123123
-                    },
-                    "time": 0
-                }
+                "/": Dir(time=0, cid=0, children={
+                    "dir1": Dir(time=11111, cid=1, children={
+                        "file1.ext": File(time=12345, size=1048576, fid=2, pickcode="abcde", sha=b"..."),
+                        "file2.ext": File(time=12346, size=1048576, fid=3, pickcode="fghij", sha=b"...")
+                    }),
+                    "dir2": Dir(time=123123, cid=4, children={
+                        "dir3": Dir(time=22222, cid=5, children={})
+                    })
+                })
             }
+        self.listed: cid and the time its listing was fetched
+        self.synced: cid and (newest user_ptime seen in its listings, time of its last full listing)
+        self.links: pickcode and its cached download link: (url, cookie, expires)
         """
         self.cache_time = 10 * 60
+        self.page_size = 115  # entries per ls request
+        self.ls_workers = 8  # concurrent page requests per ls
+        self.dir_page_size = 50  # folders per dir request
+        self.batch_size = 500  # fid[i] items per move, rename or delete request
+        self.task_batch_size = 15  # urls per add_task_urls request
+        self.dir_ttl = dir_ttl
+        self.listed = {}
+        self.synced = {}
+        self.full_sync_interval = 60 * 60  # stale folders are refreshed by delta, in full at most this long apart
+        self._refreshing = set()
+        self.refresher = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='refresh')  # stale directories, queued
+        self.negative_ttl = 60  # seconds a missing path is remembered
+        self.negative_max = 100000  # missing paths remembered at most
+        self.negative = collections.OrderedDict()  # path=(expires, deepest existing ancestor, its gen), oldest first
+        self.flight = SingleFlight()  # coalesces listings by cid and link lookups by pickcode
+        self.links = collections.OrderedDict()  # least recently stored first
+        self.links_max = 10000  # links cached at most
+        self.link_margin = 5 * 60  # refresh links this long before they expire
+        self.link_ttl = 60 * 60  # assumed lifetime of links without t= expiry
         self.s = requests.Session()
+        # one pool per host, large enough for every FUSE thread and ls worker
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+        self.s.mount('https://', adapter)
+        self.s.mount('http://', adapter)
         self.s.headers.update(headers)
         for i in cookies:
             self.s.cookies.set(**i)
+        self.api = Scheduler(self.s, families={urllib.parse.urlsplit(v).netloc: k for k, v in hosts.items()})  # every api call goes through it: rate limits, timeouts, retries
         self.default_dir = 0
         self.uid = self.s.cookies.get('UID').split('_', 1)[0]
         self.sign = ''
@@ -67,49 +204,143 @@ class Connect115(object):
         self._fs = {'last_update': 0}
         self.dirs = {0: {}}
         self._dirs_lookup = {}
-        self.path = self.Path()
-        self.path['/'] = {"time": 0, "cid": 0}
+        self.path = self.Path(forget=self._forget)
+        self.path['/'] = Dir(0, 0)
+        self.index = None
+        if index:
+            self.index = Index(index)
+            self._load_index()
         self.listdir('/')
 
     # noinspection PyCallByClass
-    class Path(collections.MutableMapping, dict):
+    class Path(collections.abc.MutableMapping, dict):
         # doesn't allow same name for file and directory
+        def __init__(self, forget=None):
+            """
+            :param forget: called with the cid of every directory dropped from the tree for good
+            """
+            super().__init__()
+            self.lock = threading.RLock()
+            self.nodes = {}  # flat index: abspath=node, same objects as in the nested tree
+            self.ids = {}  # cid or fid=abspath, for find
+            self.forget = forget
+
         def __getitem__(self, key):
-            # assume always abspath
-            _path = key.strip('/')
-            if _path:
-                path = ['/'] + _path.split('/')
-            else:
-                path = ['/']
-            try:
-                result = {}
-                node = functools.reduce(dict.__getitem__, path, self)
-                if 'cid' in node:  # is dir
-                    for k, v in node.items():
-                        result[k] = v
-                else:  # is file
-                    for k in ['time', 'size', 'fid', 'pickcode', 'sha']:
-                        result[k] = node[k]
-                return result
-            except KeyError:
-                # TODO: retrieve path from remote first
+            """
+            constant time lookup, no copying
+            :param key: abs path
+            :return: File or Dir node, to be treated as read-only, False if unknown
+            """
+            node = self.nodes.get('/' + key.strip('/'))
+            if node is None:  # not cached, Connect115.resolve lists its way down
                 return False
+            return node
 
         def __setitem__(self, key, value):
-            dict.__setitem__(self, key, value)
+            with self.lock:
+                dict.__setitem__(self, key, value)
+                self.nodes['/' + key.strip('/')] = value
+                self.ids[self._id(value)] = '/' + key.strip('/')
 
         def setpath(self, parent, key, value):
-            _path = parent.strip('/')
+            parent = '/' + parent.strip('/')
             key = key.strip('/')
-            if _path:
-                path = ['/'] + _path.split('/')
-            else:
-                path = ['/']
-            d = functools.reduce(dict.__getitem__, path, self)
-            if key in d:
-                d[key].update(value)
-            else:
-                d[key] = value
+            path = ppath.join(parent, key)
+            with self.lock:
+                d = self.nodes[parent]
+                node = d.children.get(key)
+                if node is not None and node.is_dir == value.is_dir:
+                    i = self._id(node)
+                    if node.update(value):
+                        d.touch()
+                        if self._id(node) != i:
+                            if self.ids.get(i) == path:
+                                del self.ids[i]
+                            self.ids[self._id(node)] = path
+                else:
+                    if node is not None:
+                        self._unindex(path, node, forget=True)
+                    d.children[key] = value
+                    self.nodes[path] = value
+                    self.ids[self._id(value)] = path
+                    d.touch()
+
+        def prune(self, parent, keep):
+            # drop children of parent that are not in keep
+            parent = '/' + parent.strip('/')
+            with self.lock:
+                d = self.nodes[parent]
+                removed = [k for k in d.children if k not in keep]
+                for k in removed:
+                    self._unindex(ppath.join(parent, k), d.children.pop(k), forget=True)
+                if removed:
+                    d.touch()
+            return removed
+
+        def detach(self, path, forget=False):
+            """
+            take a node out of its parent, with everything below it
+            :param path: abs path
+            :param forget: the node will not be attached again
+            :return: the node, None if it was not there
+            """
+            path = '/' + path.strip('/')
+            parent, key = ppath.split(path)
+            with self.lock:
+                d = self.nodes.get(parent)
+                node = d.children.pop(key, None) if d else None
+                if node is not None:
+                    self._unindex(path, node, forget)
+                    d.touch()
+            return node
+
+        def attach(self, parent, key, node):
+            # put a detached node back under parent, with everything below it
+            parent = '/' + parent.strip('/')
+            with self.lock:
+                d = self.nodes[parent]
+                d.children[key] = node
+                self._index(ppath.join(parent, key), node)
+                d.touch()
+
+        def find(self, ids):
+            """
+            look nodes up by id
+            :param ids: file or directory ids as int
+            :return: dict of id=abs path, for the ones in the tree
+            """
+            with self.lock:
+                return {i: self.ids[i] for i in ids if i in self.ids}
+
+        @staticmethod
+        def _id(node):
+            return node.cid if node.is_dir else node.fid
+
+        def _index(self, path, node):
+            self.nodes[path] = node
+            self.ids[self._id(node)] = path
+            if node.is_dir:
+                for k, v in node.children.items():
+                    self._index(ppath.join(path, k), v)
+
+        def _unindex(self, path, node, forget=False):
+            self.nodes.pop(path, None)
+            if self.ids.get(self._id(node)) == path:
+                del self.ids[self._id(node)]
+            if node.is_dir:
+                if forget and self.forget:
+                    self.forget(node.cid)
+                for k, v in node.children.items():
+                    self._unindex(ppath.join(path, k), v, forget)
+
+        def children(self, path):
+            """
+            :param path: abs path of a directory
+            :return: dict of name and node, copied under lock
+            """
+            node = self.nodes.get('/' + path.strip('/'))
+            with self.lock:
+                return dict(node.children)
 
         def __delitem__(self, key):
             dict.__delitem__(self, key)
@@ -124,58 +355,359 @@ class Connect115(object):
             return dict.__contains__(self, key)
 
     def update_sign(self):
-        url = 'https://115.com/?ct=offline&ac=space&_={}'.format(int(time.time() * 1e3))
-        result = self.s.get(url, headers={'Referer': referer['115'].format(self.default_dir)}).json()
+        url = hosts['115'] + '/?ct=offline&ac=space&_={}'.format(int(time.time() * 1e3))
+        result = self.api.get(url, headers={'Referer': referer['115'].format(self.default_dir)}).json()
         self.sign = result['sign']
         self.time = result['time']
 
     def fs(self) -> dict:
         now = time.time()
         if self._fs['last_update'] + self.cache_time < now:
-            url = 'https://webapi.115.com/files/index_info'
-            result = self.s.get(url, headers={'Referer': referer['115'].format(self.default_dir)}).json()
-            self._fs = {'last_update': now, 'free': result['data']['space_info']['all_remain']['size'], 'total': result['data']['space_info']['all_total']['size']}
+            url = hosts['webapi'] + '/files/index_info'
+            result = self.api.get(url, headers={'Referer': referer['115'].format(self.default_dir)}).json()
+            self._set_fs(result, now)
         return self._fs
 
+    def _set_fs(self, result, now):
+        self._fs = {'last_update': now, 'free': result['data']['space_info']['all_remain']['size'], 'total': result['data']['space_info']['all_total']['size']}
+
     def listdir(self, path):
-        # TODO: proper caching
+        """
+        list directory content from cache, the directory is fetched on first access
+        a listing older than self.dir_ttl is returned as is while one background refresh runs
+        :param path: abs path
+        :return: dict of name and attributes, empty if path is not a directory
+        """
+        node = self.load(path)
+        if not node or not node.is_dir:
+            return {}
+        return self.path.children(path)
+
+    def load(self, path):
+        """
+        look up a path as resolve does and, for a directory, list its content as listdir does
+        :param path: abs path
+        :return: File or Dir node, False if it does not exist
+        """
         if not path.startswith('/'):
             path = '/' + path
         path = ppath.abspath(path)
-        result = self.path[path]
-        if result and 'cid' in result and len(result) > 2:
-            del result['cid']
-            # del result['time']
-            return result
-        if path == '/':
-            return self._listdir(path)
-        parent = path.strip('/').rsplit('/', 1)[0]
-        self._listdir(parent)
-        self._listdir(path)
-        self.listdir(parent)
-        result = self.path[path]
-        if 'cid' in result:  # is dir
-            del result['cid']
-            # del result['time']
-        return result
+        node = self.resolve(path)
+        if node and node.is_dir:
+            self._ensure_listed(path, node)
+        return node
+
+    def resolve(self, path):
+        """
+        look up a path, walking down from the root one component at a time
+        each ancestor that was never listed is listed once, a missing name is remembered for self.negative_ttl seconds
+        or until its deepest existing ancestor changes, so repeated probes never reach the network
+        :param path: abs path
+        :return: File or Dir node, False if it does not exist
+        """
+        node = self.path[path]
+        if node:
+            return node
+        path = ppath.abspath('/' + path.strip('/'))
+        if self._missing(path):
+            return False
+        parent, node = '/', self.path['/']
+        for name in path.strip('/').split('/'):
+            self._ensure_listed(parent, node)
+            child = ppath.join(parent, name)
+            node = self.path[child]
+            if not node or (not node.is_dir and child != path):
+                self._remember_missing(path, parent)
+                return False
+            parent = child
+        return node
+
+    def _ensure_listed(self, path, node):
+        # list a directory on first access, refresh it in background once stale
+        fetched = self.listed.get(node.cid)
+        if fetched is None:
+            stats.inc('dir_cache_total', result='miss')
+            self._listdir(path)
+        elif fetched + self.dir_ttl < time.time():
+            stats.inc('dir_cache_total', result='stale')
+            self._refresh(path, node.cid)
+        else:
+            stats.inc('dir_cache_total', result='hit')
+
+    def _missing(self, path) -> bool:
+        entry = self.negative.get(path)
+        if entry is None:
+            return False
+        expires, ancestor, gen = entry
+        node = self.path[ancestor]
+        if expires > time.time() and node and node.gen == gen:
+            stats.inc('negative_cache_total', result='hit')
+            return True
+        self.negative.pop(path, None)
+        return False
+
+    def _remember_missing(self, path, ancestor):
+        stats.inc('negative_cache_total', result='miss')
+        node = self.path[ancestor]
+        with self.path.lock:
+            self.negative[path] = (time.time() + self.negative_ttl, ancestor, node.gen)
+            self.negative.move_to_end(path)
+            while len(self.negative) > self.negative_max:
+                self.negative.popitem(last=False)
+
+    def _forget(self, cid):
+        # a directory left the tree, should its cid show up again it has to be listed
+        self.listed.pop(cid, None)
+        self.synced.pop(cid, None)
+
+    def invalidate(self, path):
+        """
+        expire cached listing of a directory, it will be refreshed on next listdir
+        :param path: abs path
+        """
+        node = self.path[path]
+        if node and node.is_dir and node.cid in self.listed:
+            self.listed[node.cid] = 0
+
+    def _refresh(self, path, cid):
+        with self.path.lock:
+            if cid in self._refreshing:
+                return
+            self._refreshing.add(cid)
+
+        def refresh():
+            try:
+                self.sync(path)
+            except Exception as e:
+                log.warning('refresh %s failed: %s', path, e)
+            finally:
+                self._refreshing.discard(cid)
+        self.refresher.submit(refresh)
 
     def _listdir(self, path):
-        print('listdir', path)
-        if not self.path[path] or 'cid' not in self.path[path] or len(self.path[path]) > 2:
+        log.debug('listdir %s', path)
+        node = self.path[path]
+        if not node or not node.is_dir:
             return
-        for i in self.ls(self.path[path]['cid']):
-            if 'te' in i:
-                i['t'] = i['te']
+        self.flight.do(('ls', node.cid), lambda: self._store(path, node, self.ls(node.cid)))
+
+    def sync(self, path) -> bool:
+        """
+        refresh a listed directory by reading only what was added since its last listing
+        listings are sorted by user_ptime, newest first, so paging stops at the first entry older than the newest
+        one seen before; if the reported count then differs from known + new entries something was deleted and
+        the directory is listed in full, as it is when it was never listed or its last full listing is too old
+        renames and edits do not change user_ptime, they show up with the next full listing
+        :return: True if the delta was enough, False if the directory was listed in full
+        """
+        log.debug('sync %s', path)
+        node = self.path[path]
+        if not node or not node.is_dir:
+            return False
+        return self.flight.do(('ls', node.cid), self._sync, path, node)
+
+    def _sync(self, path, node):
+        fresh = None
+        synced = self.synced.get(node.cid)
+        if synced and synced[1] + self.full_sync_interval > time.time():
+            plan = self._delta(self.path.children(path), synced[0])
+            try:
+                offset = next(plan)
+                while True:
+                    offset = plan.send(self._ls(node.cid, offset))
+            except StopIteration as e:
+                fresh = e.value
+        if fresh is None:
+            stats.inc('dir_sync_total', result='full')
+            self._store(path, node, self.ls(node.cid))
+            return False
+        stats.inc('dir_sync_total', result='delta')
+        self._store(path, node, fresh, complete=False)
+        return True
+
+    def _delta(self, known: dict, mark: int):
+        """
+        plan a delta listing: a generator yielding the offsets to list and sent their ls results
+        folders come first, each block newest first, so an old folder means the remaining folders are known
+        and listing skips to the last one, which must be followed by the first file
+        :param known: name=Dir or File, the children as of the last listing
+        :param mark: newest user_ptime seen in the last listing
+        :return: as StopIteration value, the entries at or after mark or None when only a full listing will do
+        """
+        fresh = []
+        offset = 0
+        boundary = False  # the page starts with the last folder
+        while True:
+            result = yield offset
+            count = int(result['count'])
+            data = result['data']
+            if boundary and not self._follows(data, 0):
+                return None  # folders were added or removed, the jump missed the end of the folders
+            n = 1 if boundary else 0
+            boundary = False
+            while n < len(data):
+                i = data[n]
+                n += 1
+                if self._ptime(i) >= mark:
+                    fresh.append(i)
+                elif 's' in i:
+                    return self._counted(fresh, known, count)
+                elif i['n'] not in known:
+                    return None  # an old folder never seen, the last listing missed it
+                else:
+                    names = {j['n'] for j in fresh if 's' not in j}
+                    folders = len(names) + sum(1 for k, v in known.items() if v.is_dir and k not in names)
+                    last = folders - 1 - offset  # in data
+                    if last < n - 1:
+                        return None
+                    if last >= len(data):
+                        offset += last
+                        boundary = True
+                        break
+                    if not self._follows(data, last):
+                        return None
+                    n = last + 1
+            else:
+                offset += len(data)
+                if not data or offset >= count:
+                    return self._counted(fresh, known, count)
+
+    @staticmethod
+    def _follows(data: list, last: int) -> bool:
+        # data[last] is a folder followed by a file or the end of the page
+        return last < len(data) and 's' not in data[last] and (last + 1 == len(data) or 's' in data[last + 1])
+
+    @staticmethod
+    def _counted(fresh: list, known: dict, count: int):
+        added = {i['n'] for i in fresh if i['n'] not in known}
+        return fresh if len(known) + len(added) == count else None
+
+    @staticmethod
+    def _ptime(entry: dict) -> int:
+        return int(entry.get('tp') or entry.get('te') or entry['t'])
+
+    def _store(self, path, node, entries, complete=True):
+        """
+        merge a listing into self.path and the index
+        :param entries: ls results as they arrive
+        :param complete: entries are the whole directory, children not among them are removed
+        """
+        now = time.time()
+        mark, full = self.synced.get(node.cid, (0, 0))
+        if complete:
+            mark, full = 0, now
+        names = set()
+        rows = [(path, node.cid, None, None, None, None, node.time, self.listed.get(node.cid, now), now)]
+        for i in entries:
+            name = sys.intern(i['n'])
+            child = ppath.join(path, name)
             if 's' in i:
-                self.path.setpath(path, i['n'], {'time': int(i['t']), 'size': int(i['s']), 'fid': int(i['fid']), 'pickcode': i['pc'], 'sha': i['sha']})
+                f = File.parse(i)
+                rows.append((child, None, f.fid, f.pickcode, f.sha, f.size, f.time, now, None))
             else:
-                self.path.setpath(path, i['n'], {'time': int(i['t']), 'cid': int(i['cid'])})
+                f = Dir.parse(i)
+                rows.append((child, f.cid, None, None, None, None, f.time, now, self.listed.get(f.cid)))
+            self.path.setpath(path, name, f)
+            names.add(name)
+            mark = max(mark, self._ptime(i))
+        removed = self.path.prune(path, names) if complete else []
+        self.listed[node.cid] = now
+        self.synced[node.cid] = (mark, full)
+        if self.index:
+            self.index.save(rows, [ppath.join(path, k) for k in removed])
+
+    def _load_index(self):
+        for path, cid, fid, pickcode, sha, size, t, fetched, listed in self.index.load():
+            if cid is not None and listed:
+                self.listed[cid] = listed
+            if path == '/':
+                continue
+            parent, name = ppath.split(path)
+            try:
+                if cid is None:
+                    self.path.setpath(parent, sys.intern(name), File(t, size, fid, pickcode, sha))
+                else:
+                    self.path.setpath(parent, sys.intern(name), Dir(t, cid))
+            except (KeyError, AttributeError):  # parent went missing
+                continue
+
+    def crawl(self, path: str = '/', workers: int = 8, qps: float = 10, refresh: bool = False) -> int:
+        """
+        list a whole subtree breadth-first, filling self.path, self.dirs and self._dirs_lookup in bulk
+        every page of every directory is one job for the worker pool
+        :param path: abs path of the subtree root
+        :param workers: concurrent requests
+        :param qps: max requests per second
+        :param refresh: list directories again even if they are cached
+        :return: number of directories listed
+        """
+        limit = TokenBucket(qps)
+        pending = {}  # path=[entries, pages left]
+        listed = 0
 
-    def ls(self, folder_id: int = -1) -> list:
+        def page(p, cid, offset):
+            limit.wait()
+            try:
+                return p, cid, offset, self._ls(cid, offset)
+            except Exception as e:
+                log.warning('crawl %s failed: %s', p, e)
+                return p, cid, offset, None
+
+        def add_dirs(cid, children):
+            # children: (name, cid) of sub directories
+            if cid == 0 or cid in self._dirs_lookup:
+                self._add_dirs([{'n': name, 'cid': i, 'pid': cid} for name, i in children])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            jobs = set()
+
+            def visit(p):
+                node = self.path[p]
+                if not node or not node.is_dir:
+                    return
+                if refresh or node.cid not in self.listed:
+                    jobs.add(pool.submit(page, p, node.cid, 0))
+                    return
+                subdirs = [(k, v.cid) for k, v in self.path.children(p).items() if v.is_dir]  # cached, only descend
+                add_dirs(node.cid, subdirs)
+                for k, _ in subdirs:
+                    visit(ppath.join(p, k))
+
+            path = ppath.abspath('/' + path.strip('/'))
+            if not self.path[path]:
+                self.load(path)
+            visit(path)
+            while jobs:
+                done, jobs = concurrent.futures.wait(jobs, return_when=concurrent.futures.FIRST_COMPLETED)
+                for job in done:
+                    p, cid, offset, result = job.result()
+                    if result is None:  # incomplete directories are not stored
+                        pending.pop(p, None)
+                        continue
+                    if offset == 0:
+                        pages = range(self.page_size, int(result['count']), self.page_size)
+                        pending[p] = [result['data'], len(pages)]
+                        for offset in pages:
+                            jobs.add(pool.submit(page, p, cid, offset))
+                    elif p in pending:
+                        pending[p][0].extend(result['data'])
+                        pending[p][1] -= 1
+                    if p in pending and pending[p][1] == 0:
+                        entries = pending.pop(p)[0]
+                        self._store(p, self.path[p], entries)
+                        listed += 1
+                        subdirs = [(i['n'], int(i['cid'])) for i in entries if 's' not in i]
+                        add_dirs(cid, subdirs)
+                        for name, _ in subdirs:
+                            visit(ppath.join(p, name))
+        return listed
+
+    def ls(self, folder_id: int = -1):
         """
-        list files and directories under directory
+        list files and directories under directory, paging through the whole folder
+        the first page tells the total count, the remaining pages are fetched concurrently
         :param folder_id: folder id as int
-        :return: dict: [{
+        :return: generator of dict, yielded as pages arrive: [{
             "fid": "1162242889158390665",
             "uid": 362421191,
             "aid": 1,
@@ -204,15 +736,28 @@ class Connect115(object):
             "fl": []
         }]
         """
-        print('ls', folder_id)
+        log.debug('ls %s', folder_id)
         if folder_id == -1:
             folder_id = self.default_dir
-        url = 'https://webapi.115.com/files?aid=1&cid={}&o=user_ptime&asc=0&offset=0&show_dir=1&limit=115&code=&scid=' \
-              '&snap=0&natsort=1&custom_order=2&source=&format=json&type=&star=&is_q=&is_share='.format(folder_id)
-        result = self.s.get(url, headers={'Referer': referer['115'].format(self.default_dir)}).json()
-        if result['errNo'] == 0:
-            data = result['data']
-            return data
+        result = self._ls(folder_id, 0)
+        yield from result['data']
+        count = int(result['count'])
+        if count <= self.page_size:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.ls_workers) as pool:
+            pages = [pool.submit(self._ls, folder_id, offset) for offset in range(self.page_size, count, self.page_size)]
+            for page in concurrent.futures.as_completed(pages):
+                yield from page.result()['data']
+
+    def _ls(self, folder_id: int, offset: int) -> dict:
+        result = self.api.get(self._ls_url(folder_id, offset), headers={'Referer': referer['115'].format(self.default_dir)}).json()
+        if result['errNo'] != 0:
+            raise IOError('ls {} at offset {} failed: {}'.format(folder_id, offset, result.get('error')))
+        return result
+
+    def _ls_url(self, folder_id: int, offset: int) -> str:
+        return hosts['webapi'] + '/files?aid=1&cid={}&o=user_ptime&asc=0&offset={}&show_dir=1&limit={}&code=&scid=' \
+               '&snap=0&natsort=1&custom_order=2&source=&format=json&type=&star=&is_q=&is_share='.format(folder_id, offset, self.page_size)
 
     def dir(self, folder_id: int = 0) -> list:
         """
@@ -236,28 +781,43 @@ class Connect115(object):
             "hdf": 0
         }
         """
-        url = 'https://aps.115.com/natsort/files.php?aid=1&cid={}&offset=0&limit=50&show_dir=1&o=file_name&asc=1&nf=1' \
-              '&qid=0&natsort=1&source=&format=json'.format(folder_id)
-        result = self.s.get(url, headers={'Referer': referer['aps']}).json()
-        if result['errNo'] == 0:
-            data = result['data']
-            for folder in data:
-                name = folder['n']
-                parent_id = int(folder['pid'])
-                folder_id = int(folder['cid'])
-                if parent_id == 0:
-                    self._dirs_lookup[folder_id] = [0]
-                else:
-                    self._dirs_lookup[folder_id] = self._dirs_lookup[parent_id] + [parent_id]  # TODO: pid not in lookup
-                if not self.default_dir and name == '云下载':
-                    self.default_dir = folder_id
-                parents = self._dirs_lookup[folder_id]
-                parent = functools.reduce(dict.__getitem__, parents, self.dirs)
-                if folder_id not in parent:
-                    parent.update({folder_id: {'name': name}})
-                else:
-                    parent.get(folder_id).update({'name': name})
-            return data
+        result = self.api.get(self._dir_url(folder_id, 0), headers={'Referer': referer['aps']}).json()
+        if result['errNo'] != 0:
+            return
+        data = result['data']
+        count = int(result.get('count', len(data)))
+        if count > self.dir_page_size:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.ls_workers) as pool:
+                pages = pool.map(lambda offset: self.api.get(self._dir_url(folder_id, offset), headers={'Referer': referer['aps']}).json(),
+                                 range(self.dir_page_size, count, self.dir_page_size))
+                for result in pages:
+                    if result['errNo'] == 0:
+                        data.extend(result['data'])
+        return self._add_dirs(data)
+
+    def _dir_url(self, folder_id: int, offset: int) -> str:
+        return hosts['aps'] + '/natsort/files.php?aid=1&cid={}&offset={}&limit={}&show_dir=1&o=file_name&asc=1&nf=1' \
+               '&qid=0&natsort=1&source=&format=json'.format(folder_id, offset, self.dir_page_size)
+
+    def _add_dirs(self, data: list) -> list:
+        # record folders from a dir() result in self.dirs and self._dirs_lookup
+        for folder in data:
+            name = folder['n']
+            parent_id = int(folder['pid'])
+            folder_id = int(folder['cid'])
+            if parent_id == 0:
+                self._dirs_lookup[folder_id] = [0]
+            else:
+                self._dirs_lookup[folder_id] = self._dirs_lookup[parent_id] + [parent_id]  # TODO: pid not in lookup
+            if not self.default_dir and name == '云下载':
+                self.default_dir = folder_id
+            parents = self._dirs_lookup[folder_id]
+            parent = functools.reduce(dict.__getitem__, parents, self.dirs)
+            if folder_id not in parent:
+                parent.update({folder_id: {'name': name}})
+            else:
+                parent.get(folder_id).update({'name': name})
+        return data
 
     def mv(self, src: int, dest: int) -> bool:
         """
@@ -266,17 +826,35 @@ class Connect115(object):
         :param dest: destination directory, directory id as int
         :return: True or None
         """
-        url = 'https://webapi.115.com/files/move'
-        result = self.s.post(url, data={'pid': dest, 'fid[0]': src}, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
-        if result['errno'] == '':
-            _ = functools.reduce(dict.__getitem__, self._dirs_lookup[src], self.dirs)  # TODO: need to test
-            self._dirs_lookup[src] = self._dirs_lookup[dest].append(dest)
-            parent = functools.reduce(dict.__getitem__, self._dirs_lookup[src], self.dirs)
-            if src not in parent:
-                parent.update({src: _})
-            else:
-                parent.get(src).update(_)
-            return True
+        return self.mv_batch([src], dest)
+
+    def mv_batch(self, srcs: list, dest: int) -> bool:
+        """
+        move files and directories to a directory, self.batch_size per request
+        each accepted request moves its items in self.path, self.dirs and the index at once, no re-listing needed
+        :param srcs: file or directory ids as int
+        :param dest: destination directory, directory id as int
+        :return: True if every request succeeded, else None
+        """
+        url = hosts['webapi'] + '/files/move'
+        ok = True
+        for chunk in self._chunks(srcs, self.batch_size):
+            data = {'pid': dest}
+            data.update(('fid[{}]'.format(i), fid) for i, fid in enumerate(chunk))
+            result = self.api.post(url, data=data, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
+            if result['errno'] != '':
+                ok = False
+                continue
+            with self.path.lock:
+                paths = self.path.find(chunk + [dest])
+                target = paths.get(dest)
+                moved = []
+                for fid in chunk:
+                    self._move_dir(fid, dest)
+                    if fid in paths:
+                        moved.append((paths[fid], target))
+                self._patch(moved)
+        return ok or None
 
     def ren(self, src: int, new_name: str) -> bool:
         """
@@ -285,12 +863,32 @@ class Connect115(object):
         :param new_name: new filename as string
         :return: True or None
         """
-        url = 'https://webapi.115.com/files/edit'
-        result = self.s.post(url, data={'fid': src, 'file_name': new_name}, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
-        if result['errno'] == '':
-            if src in self._dirs_lookup:  # TODO: need to test
-                functools.reduce(dict.__getitem__, self._dirs_lookup[src], self.dirs).update(name=new_name)
-            return True
+        return self.ren_batch({src: new_name})
+
+    def ren_batch(self, names: dict) -> bool:
+        """
+        rename files and directories, self.batch_size per request, patched locally like mv_batch
+        :param names: file or directory id as int=new name as string
+        :return: True if every request succeeded, else None
+        """
+        url = hosts['webapi'] + '/files/batch_rename'
+        ok = True
+        for chunk in self._chunks(list(names.items()), self.batch_size):
+            data = {'files_new_name[{}]'.format(fid): name for fid, name in chunk}
+            result = self.api.post(url, data=data, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
+            if result['errno'] != '':
+                ok = False
+                continue
+            with self.path.lock:
+                paths = self.path.find([fid for fid, _ in chunk])
+                moved = []
+                for fid, name in chunk:
+                    if fid in self._dirs_lookup:
+                        functools.reduce(dict.__getitem__, self._dirs_lookup[fid], self.dirs)[fid]['name'] = name
+                    if fid in paths:
+                        moved.append((paths[fid], ppath.dirname(paths[fid]), name))
+                self._patch(moved)
+        return ok or None
 
     def mkdir(self, pwd: int, new_name: str) -> bool:
         """
@@ -299,19 +897,44 @@ class Connect115(object):
         :param new_name: new directory name as string
         :return: True or None
         """
-        url = 'https://webapi.115.com/files/add'
-        result = self.s.post(url, data={'pid': pwd, 'cname': new_name}, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
+        if self.mkdir_batch(pwd, [new_name]):
+            return True
+
+    def mkdir_batch(self, pwd: int, names: list) -> dict:
+        """
+        create directories in one directory, the api takes one name per request so they are sent concurrently
+        :param pwd: current directory, directory id as int
+        :param names: new directory names as string
+        :return: dict of name=new directory id as int, only the created ones
+        """
+        url = hosts['webapi'] + '/files/add'
+
+        def add(name):
+            return self.api.post(url, data={'pid': pwd, 'cname': name}, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
         '''{"state":true,"error":"","errno":"","aid":1,"cid":"1173956375760499041","cname":"Anime",
         "file_id":"1173956375760499041","file_name":"Anime"}'''
-        if result['errno'] == '':
-            folder_id = result['cid']
-            if pwd == 0:
-                self._dirs_lookup[folder_id] = [0]
-            else:
-                self._dirs_lookup[folder_id] = self._dirs_lookup[pwd] + [pwd]  # TODO: pwd not in lookup
-            parents = self._dirs_lookup[folder_id]
-            functools.reduce(dict.__getitem__, parents, self.dirs).update({folder_id: {'name': result['file_name']}})
-            return True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.ls_workers) as pool:
+            results = list(pool.map(add, names))
+        created = {}
+        now = time.time()
+        with self.path.lock:
+            parent = self.path.find([pwd]).get(pwd)
+            rows = []
+            for result in results:
+                if result['errno'] != '':
+                    continue
+                folder_id = int(result['cid'])
+                name = result['file_name']
+                created[name] = folder_id
+                if pwd == 0 or pwd in self._dirs_lookup:
+                    self._add_dirs([{'n': name, 'cid': folder_id, 'pid': pwd}])
+                if parent:
+                    self.path.setpath(parent, sys.intern(name), Dir(int(now), folder_id))
+                    self.listed[folder_id] = now  # new and empty, nothing to list
+                    rows.append((ppath.join(parent, name), folder_id, None, None, None, None, int(now), now, now))
+            if self.index and rows:
+                self.index.save(rows)
+        return created
 
     def rm(self, pwd: int, target: int) -> bool:
         """
@@ -320,13 +943,147 @@ class Connect115(object):
         :param target: file to be removed, file id as int
         :return: True or None
         """
-        url = 'https://webapi.115.com/rb/delete'
-        result = self.s.post(url, data={'pid': pwd, 'fid[0]': target}, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
-        if result['errno'] == '':
-            if target in self._dirs_lookup:
-                functools.reduce(dict.__getitem__, self._dirs_lookup[target], self.dirs).pop(target)
-                del self._dirs_lookup[target]
-            return True
+        return self.rm_batch(pwd, [target])
+
+    def rm_batch(self, pwd: int, targets: list) -> bool:
+        """
+        remove files and directories, self.batch_size per request, patched locally like mv_batch
+        :param pwd: current directory, directory id as int
+        :param targets: file or directory ids as int
+        :return: True if every request succeeded, else None
+        """
+        url = hosts['webapi'] + '/rb/delete'
+        ok = True
+        for chunk in self._chunks(targets, self.batch_size):
+            data = {'pid': pwd}
+            data.update(('fid[{}]'.format(i), fid) for i, fid in enumerate(chunk))
+            result = self.api.post(url, data=data, headers={'Origin': origin['webapi'], 'Referer': referer['115'].format(self.default_dir)}).json()
+            if result['errno'] != '':
+                ok = False
+                continue
+            with self.path.lock:
+                paths = self.path.find(chunk)
+                for target in chunk:
+                    self._move_dir(target, None)
+                self._patch([(paths[i], None) for i in chunk if i in paths])
+        return ok or None
+
+    @staticmethod
+    def _chunks(items: list, size: int):
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    def _move_dir(self, cid: int, dest):
+        # move a folder of self.dirs under dest, drop it when dest is None or unknown
+        if cid not in self._dirs_lookup:
+            return
+        entry = functools.reduce(dict.__getitem__, self._dirs_lookup[cid], self.dirs).pop(cid)
+        stack = [(cid, entry)]
+        while stack:  # descendants keep their place in entry, only their lookup changes
+            i, e = stack.pop()
+            del self._dirs_lookup[i]
+            stack.extend((k, v) for k, v in e.items() if k != 'name')
+        if dest is None or (dest != 0 and dest not in self._dirs_lookup):
+            return
+        parents = [0] if dest == 0 else self._dirs_lookup[dest] + [dest]
+        functools.reduce(dict.__getitem__, parents, self.dirs)[cid] = entry
+        stack = [(cid, entry, parents)]
+        while stack:
+            i, e, parents = stack.pop()
+            self._dirs_lookup[i] = parents
+            stack.extend((k, v, parents + [i]) for k, v in e.items() if k != 'name')
+
+    def _patch(self, moves: list):
+        # apply accepted moves to self.path and the index, caller holds self.path.lock
+        # moves: (path, new parent path or None to remove[, new name])
+        rows, removed = [], []
+        for move in moves:
+            path, parent = move[:2]
+            name = move[2] if len(move) > 2 else ppath.basename(path)
+            target = ppath.join(parent, name) if parent else None
+            if target == path:  # moved into its own directory or renamed to its own name
+                continue
+            conflict = bool(target and self.path[target])  # the server renames, get its name with the next listing
+            keep = bool(target and self.path[parent]) and not conflict  # not removed or moved out of sight
+            node = self.path.detach(path, forget=not keep)
+            removed.append(path)
+            if conflict:
+                self.invalidate(parent)
+            if not node or not keep:
+                continue
+            self.path.attach(parent, sys.intern(name), node)
+            rows.extend(self._rows(target, node))
+        if self.index and (rows or removed):
+            self.index.save(rows, removed)
+
+    def _rows(self, path, node):
+        # index rows of node and everything below it
+        now = time.time()
+        if not node.is_dir:
+            return [(path, None, node.fid, node.pickcode, node.sha, node.size, node.time, now, None)]
+        rows = [(path, node.cid, None, None, None, None, node.time, now, self.listed.get(node.cid))]
+        for name, child in node.children.items():
+            rows.extend(self._rows(ppath.join(path, name), child))
+        return rows
+
+    def upload(self, filename: str, dest: int, name: str):
+        """
+        upload a local file into a directory
+        the sha1 is offered first: content 115 already has is added instantly, after proving it with the sha1 of a
+        range the server picks, and only unknown content is sent
+        :param filename: local file
+        :param dest: destination directory, directory id as int
+        :param name: file name on 115
+        :return: File node, also added to self.path and the index, None on failure
+        """
+        size = os.path.getsize(filename)
+        sha = self._sha1(filename, 0, size)
+        url = hosts['upload'] + '/3.0/initupload.php'
+        data = {'fileid': sha.hex().upper(), 'filesize': size, 'filename': name, 'target': 'U_1_{}'.format(dest), 'userid': self.uid}
+        result = self.api.post(url, data=data, headers={'Origin': origin['115']}).json()
+        if result.get('status') == 7:  # prove we hold the content
+            start, end = map(int, result['sign_check'].split('-'))
+            data.update(sign_key=result['sign_key'], sign_val=self._sha1(filename, start, end + 1 - start).hex().upper())
+            result = self.api.post(url, data=data, headers={'Origin': origin['115']}).json()
+        '''{"status":2,"statuscode":0,"statusmsg":"","pickcode":"dfrlfx4e1ote8x5tj","fileid":"1173954155581173992"}'''
+        if result.get('status') == 2:
+            stats.inc('uploads_total', result='instant')
+            fid, pickcode = result['fileid'], result['pickcode']
+        elif result.get('status') == 1:
+            with open(filename, 'rb') as f:  # rewound by the scheduler before a retry
+                result = self.api.post(result['upload_url'], data=f, headers={'Content-Length': str(size)}).json()
+            '''{"state":true,"data":{"file_id":"1173954155581173992","pick_code":"dfrlfx4e1ote8x5tj","sha1":"...","file_size":223092533}}'''
+            if not result.get('state'):
+                stats.inc('uploads_total', result='failed')
+                return
+            stats.inc('uploads_total', result='sent')
+            stats.inc('uploaded_bytes_total', size)
+            fid, pickcode = result['data']['file_id'], result['data']['pick_code']
+        else:
+            stats.inc('uploads_total', result='failed')
+            return
+        now = time.time()
+        f = File(int(now), size, int(fid), pickcode, sha)
+        with self.path.lock:
+            parent = self.path.find([dest]).get(dest)
+            if parent:
+                self.path.setpath(parent, sys.intern(name), f)
+                if self.index:
+                    self.index.save(self._rows(ppath.join(parent, name), f))
+        return f
+
+    @staticmethod
+    def _sha1(filename: str, offset: int, length: int) -> bytes:
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(length, 1024 ** 2))
+                if not chunk:
+                    break
+                h.update(chunk)
+                length -= len(chunk)
+        return h.digest()
 
     def add_magnet(self, link: str) -> bool:
         """
@@ -334,15 +1091,32 @@ class Connect115(object):
         :param link: magnet link in string
         :return: True or None
         """
-        url = 'https://115.com/web/lixian/?ct=lixian&ac=add_task_url'
-        result = self.s.post(url, data={'url': link, 'uid': self.uid, 'sign': self.sign, 'time': self.time},
-                             headers={'Origin': origin['115'], 'Referer': referer['115'].format(self.default_dir)}
-                             ).json()
-        '''{"info_hash":"186e2e8f981ab9877f12c6031e9c0ff080e30bff","name":"","state":true,"errno":0,"errtype":"suc",
-        "url":"magnet:?xt=urn:btih:DBXC5D4YDK4YO7YSYYBR5HAP6CAOGC77\u0026dn=\u0026tr...","errcode":0}'''
-        if result['errno'] == 0:
+        if self.add_magnets([link])[0]:
             return True
 
+    def add_magnets(self, links: list) -> list:
+        """
+        add magnet links to tasks, self.task_batch_size per request
+        :param links: magnet links in string
+        :return: list of bool, one per link
+        """
+        url = hosts['115'] + '/web/lixian/?ct=lixian&ac=add_task_urls'
+        added = []
+        for chunk in self._chunks(links, self.task_batch_size):
+            data = {'uid': self.uid, 'sign': self.sign, 'time': self.time}
+            data.update(('url[{}]'.format(i), link) for i, link in enumerate(chunk))
+            result = self.api.post(url, data=data,
+                                   headers={'Origin': origin['115'], 'Referer': referer['115'].format(self.default_dir)}
+                                   ).json()
+            '''{"state":true,"errno":0,"errtype":"suc","errcode":0,"result":[{"info_hash":"186e2e8f981ab9877f12c6031e9c0ff080e30bff",
+            "name":"","state":true,"errno":0,"errtype":"suc","url":"magnet:?xt=urn:btih:...","errcode":0}, ...]}'''
+            if not result.get('state'):
+                added.extend(False for _ in chunk)
+                continue
+            states = [bool(i.get('state')) for i in result.get('result', [])]
+            added.extend(states if len(states) == len(chunk) else [True] * len(chunk))
+        return added
+
     def ls_task(self, page: int = 1) -> list:
         """
         list all tasks starting from page
@@ -364,36 +1138,101 @@ class Connect115(object):
             "del_path": ""
         }]
         """
-        url = 'https://115.com/web/lixian/?ct=lixian&ac=task_lists'
-        data = {'page': page, 'uid': self.uid, 'sign': self.sign, 'time': self.time}
-        result = self.s.post(url,
-                             data=data,
-                             headers={'Origin': origin['115'], 'Referer': referer['115'].format(self.default_dir)}
-                             ).json()
-        data = result['tasks']
-        if result['errtype'] != 'suc':
+        try:
+            return list(self.tasks(page))
+        except IOError:
             return []
-        if result['page'] != result['page_count']:
-            data.append(self.ls_task(page+1))
-        return data
 
-    def get_link(self, pickcode: str) -> str:
+    def tasks(self, page: int = 1, ahead: int = None):
+        """
+        iterate over all tasks starting from page, in list order
+        once the first page tells page_count, the following pages are fetched concurrently ahead of the consumer
+        :param page: start page number as int
+        :param ahead: pages fetched ahead, defaults to self.ls_workers, keep it small when the caller may stop early
+        :return: generator of dict, see ls_task
+        """
+        result = self._task_page(page)
+        yield from result['tasks']
+        ahead = ahead or self.ls_workers
+        pages = iter(range(page + 1, int(result['page_count']) + 1))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ahead) as pool:
+            pending = collections.deque(pool.submit(self._task_page, i) for i in itertools.islice(pages, ahead))
+            try:
+                while pending:
+                    result = pending.popleft().result()
+                    i = next(pages, None)
+                    if i is not None:
+                        pending.append(pool.submit(self._task_page, i))
+                    yield from result['tasks']
+            finally:  # stopped early, do not wait for pages nobody reads
+                for future in pending:
+                    future.cancel()
+
+    def _task_page(self, page: int) -> dict:
+        url = hosts['115'] + '/web/lixian/?ct=lixian&ac=task_lists'
+        data = {'page': page, 'uid': self.uid, 'sign': self.sign, 'time': self.time}
+        result = self.api.post(url,
+                               data=data,
+                               headers={'Origin': origin['115'], 'Referer': referer['115'].format(self.default_dir)}
+                               ).json()
+        if result.get('errtype') != 'suc':
+            raise IOError('task list page {} failed: {}'.format(page, result.get('error_msg') or result.get('errtype')))
+        return result
+
+    def get_link(self, pickcode: str, stale: str = None) -> str:
         """
         get download link from pickcode
         :param pickcode: pickcode as string
+        :param stale: a link that stopped working, replaced if it is still the cached one
         :return: download url
         """
-        result = self._get_link(pickcode).json()
-        if result['msg_code'] == 0:
-            return result['file_url']
+        return self.link(pickcode, stale)[0]
+
+    def link(self, pickcode: str, stale: str = None) -> tuple:
+        """
+        get download link and its cookie from pickcode, cached until shortly before the link expires
+        :param pickcode: pickcode as string
+        :param stale: a link that stopped working, replaced if it is still the cached one
+        :return: (url, cookie), (None, None) on failure
+        """
+        cached = self._cached_link(pickcode, stale)
+        if cached:
+            return cached
+        return self.flight.do(('link', pickcode), self._fetch_link, pickcode)
+
+    def _fetch_link(self, pickcode: str) -> tuple:
+        r = self._get_link(pickcode)
+        return self._store_link(pickcode, r.json(), r.headers.get('Set-Cookie'))
+
+    def _cached_link(self, pickcode: str, stale: str = None):
+        cached = self.links.get(pickcode)
+        if cached and cached[0] != stale and cached[2] - self.link_margin > time.time():
+            return cached[:2]
+        if cached and cached[2] < time.time():
+            self.links.pop(pickcode, None)
+
+    def _store_link(self, pickcode: str, result: dict, cookie: str) -> tuple:
+        if result['msg_code'] != 0:
+            return None, None
+        url = result['file_url']
+        if urllib.parse.urlsplit(url).hostname.endswith('.115.com'):
+            url = url.replace('http://', 'https://')
+        expires = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('t')
+        expires = int(expires[0]) if expires else time.time() + self.link_ttl
+        with self.path.lock:
+            self.links[pickcode] = (url, cookie, expires)
+            self.links.move_to_end(pickcode)
+            while self.links and (len(self.links) > self.links_max or next(iter(self.links.values()))[2] < time.time()):
+                self.links.popitem(last=False)  # expired ones are mostly the oldest
+        return url, cookie
 
     def _get_link(self, pickcode: str) -> requests.Response:
         # url = "https://115.com/"
         # self.s.get(url,
         #            params={'ct': 'download', 'ac': 'index', 'pickcode': pickcode, '_t': int(time.time() * 1e3)},
         #            headers={'Referer': referer['115'].format(self.default_dir)})
-        url = 'https://webapi.115.com/files/download'
-        result = self.s.get(url, params={'pickcode': pickcode, '_': int(time.time() * 1e3)}, headers={'Referer': referer['115'].format(self.default_dir)})
+        url = hosts['webapi'] + '/files/download'
+        result = self.api.get(url, params={'pickcode': pickcode, '_': int(time.time() * 1e3)}, headers={'Referer': referer['115'].format(self.default_dir)})
         '''{"state":true,"msg":"","msg_code":0,"is_115chrome":0,"is_snap":0,"is_vip":1,"file_name":"[DMG][Imout
         o sae Ireba Ii.][01][1080P][BIG5].mp4","file_size":"223092533","pickcode":"dfrlfx4e1ote8x5tj","file_id"
         :"1173954155581173992","user_id":362421191,"file_url":"https:\/\/fscdntel-vip.115.com\/files\/c210\/1\/
@@ -407,7 +1246,53 @@ class Connect115(object):
         :param path: abs path
         :return: download url
         """
-        return self.get_link(self.path[path]['pickcode'])
+        return self.get_link(self.path[path].pickcode)
+
+
+class TaskMonitor(object):
+    final = (2, -1)  # status of finished and failed tasks, they do not change anymore
+
+    def __init__(self, x115: Connect115, settled: int = 30, full_every: int = 10):
+        """
+        poll offline tasks, reporting only the ones that changed since the previous poll
+        tasks are listed newest first, so a poll stops reading pages after settled finished tasks in a row
+        that did not change; every full_every polls all pages are read to catch older tasks and forget removed ones
+        :param settled: unchanged finished tasks in a row that end a poll, about one page
+        :param full_every: polls between full reads, the first poll is always full
+        """
+        self.x115 = x115
+        self.settled = settled
+        self.full_every = full_every
+        self.polls = 0
+        self.seen = {}  # info_hash=(percentDone, status, last_update)
+
+    def poll(self) -> list:
+        """
+        :return: list of task dict, see Connect115.ls_task, that are new or whose percentDone, status or last_update changed
+        """
+        full = self.polls % self.full_every == 0
+        self.polls += 1
+        changed = []
+        present = set()
+        streak = 0
+        for task in self.x115.tasks(ahead=None if full else 2):
+            key = task['info_hash']
+            state = (task['percentDone'], task['status'], task['last_update'])
+            present.add(key)
+            if self.seen.get(key) != state:
+                self.seen[key] = state
+                changed.append(task)
+                streak = 0
+            elif task['status'] in self.final:
+                streak += 1
+                if not full and streak >= self.settled:
+                    break
+            else:
+                streak = 0
+        if full:
+            for key in self.seen.keys() - present:
+                del self.seen[key]
+        return changed
 
 
 if __name__ == '__main__':